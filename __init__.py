@@ -1,7 +1,10 @@
 import setup_logging
 import term
 import boxtypes
+import cells
 import buffer
+import compositor
 import ansi
+import snapshot
 
 colors = term.colors
@@ -1,5 +1,10 @@
 import os, os.path
-import buffer, term
+import re
+import itertools
+import collections
+import mmap
+import cStringIO
+import buffer, term, lru
 
 import logging
 log = logging.getLogger("pytality.ansi")
@@ -201,14 +206,21 @@ def parse_escape(f, is_key=False):
 
         (Christ, I hate this "syntax")
     '''
-    global bold
-        
     #read the escape sequence
     data = read_escape(f)
     if isinstance(data, Escape):
         return data
 
     args, command = data
+    return escape_meaning(args, command)
+
+def escape_meaning(args, command):
+    '''
+        Interpret an escape sequence that's been read, as returned by read_escape.
+        
+        Returns an Escape instance.
+    '''
+    global bold
 
     def optional_arg(default=1):
         '''
@@ -325,69 +337,391 @@ def parse_escape(f, is_key=False):
     log.error("parse_escape: unknown escape sequence. command=%r, args=%r", command, args)
     return Escape('unknown', value=command)
 
-def read_to_buffer(f, width=80, max_height=None, crop=False):
+#A run of plain text, a line break, or an escape sequence - the same ones read_escape reads:
+#ESC [ args command, ESC O command, or ESC and anything else (which is ignored)
+token_re = re.compile(r'([^\x1b\r\n]+)|([\r\n])|\x1b(?:\[([0-9;]*)([^0-9;])|(O.)|([^\[O]))', re.S)
+
+def read_runs(f, width=80, crop=False, chunk_size=65536, fg=term.colors.WHITE, bg=term.colors.BLACK):
     """
+        Read ANSI art from a file-like object, yielding each row as soon as it's finished,
+        so big files can be handled a piece at a time.
+
+        Rows are lists of (fg, bg, text) runs of cells that share their colors,
+        padded out to width. The file is read in chunk_size pieces, and runs of plain
+        text are handled all at once rather than a character at a time.
+
         if crop, kill rows at :width
         otherwise, let them wrap into new rows.
-        we need both :(
+
+        fg and bg are the colors to start with.
     """
-    rows = []
+    black = term.colors.BLACK
     row = []
-    fg = term.colors.WHITE
-    bg = term.colors.BLACK
-    def add(c, _fg=None, _bg=None):
-        if _fg is not None:
-            f = _fg
-        else:
-            f = fg
-        if _bg is not None:
-            b = _bg
-        else:
-            b = bg
-        #log("f: %r b: %r c: %r (%r)" % (f, b, c, hex(ord(c))))
-        row.append([f, b, c])
-
-    def finish_row():
-        log.debug("read_to_buffer: finishing row")
-        while len(row) < width:
-            add(' ')
-        if crop:
-            xrow = row[:width]
-        else:
-            xrow = row
-        rows.append(xrow)
-        fg = term.colors.WHITE
+    row_len = 0
+    done = []
+    data = ''
+    match = token_re.match
+
+    def finish_row(row, row_len):
+        if row_len < width:
+            row.append((fg, bg, ' ' * (width - row_len)))
+        elif crop and row_len > width:
+            #escapes can push a row past the end, too
+            cropped = []
+            space = width
+            for run_fg, run_bg, text in row:
+                if space <= 0:
+                    break
+                cropped.append((run_fg, run_bg, text[:space]))
+                space -= len(text)
+            row = cropped
+        done.append(row)
+
+    eof = False
+    while not eof:
+        chunk = f.read(chunk_size)
+        eof = not chunk
+        data += chunk
+        pos = 0
+        end = len(data)
+        while pos < end:
+            token = match(data, pos)
+            if token is None or (token.end() == end and token.group(1) is None and not eof):
+                #an escape sequence cut off by the end of the chunk - finish it next time
+                if eof:
+                    log.warn("read_runs: ignoring an incomplete escape sequence at the end of the file")
+                    pos = end
+                break
+            pos = token.end()
+            text, newline, args, command, o_command, other = token.groups()
+
+            if text is not None:
+                if crop:
+                    #anything past width would be cropped off anyway
+                    space = width - row_len
+                    if space > 0:
+                        text = text[:space]
+                        row.append((fg, bg, text))
+                        row_len += len(text)
+                    continue
+                while text:
+                    piece = text[:width - row_len]
+                    row.append((fg, bg, piece))
+                    text = text[len(piece):]
+                    row_len += len(piece)
+                    if row_len >= width:
+                        finish_row(row, row_len)
+                        row = []
+                        row_len = 0
+                    else:
+                        break
+                continue
+
+            if newline is not None:
+                finish_row(row, row_len)
+                row = []
+                row_len = 0
+                continue
+
+            if command is not None:
+                esc = escape_meaning([int(arg) for arg in args.split(';') if arg], command)
+            elif o_command is not None:
+                esc = escape_meaning([], o_command)
+            elif other == '\x1b':
+                esc = Escape('esc')
+            else:
+                esc = Escape('illegal', value=['\x1b', other])
 
-    while True:
-        c = f.read(1)
-        if not c:
-            break
-        if c == chr(27): #esc
-            esc = parse_escape(f)
             if esc.meaning == 'right':
-                [add(' ', term.colors.BLACK, term.colors.BLACK) for x in range(esc.value)]
-
+                row.append((black, black, ' ' * esc.value))
+                row_len += esc.value
             elif esc.meaning == 'color':
                 if esc.fg is not None:
                     fg = esc.fg
                 if esc.bg is not None:
                     bg = esc.bg
             else:
-                log.warn("read_to_buffer: ignoring unknown meaning %r. This is probably bad.", esc.meaning)
+                log.warn("read_runs: ignoring unknown meaning %r. This is probably bad.", esc.meaning)
 
-        elif c in ('\r','\n'):
-            finish_row()
-            row = []
-        else:
-            add(c)
-        if not crop and len(row) >= width:
-            finish_row()
-            row = []
-    finish_row()
+            if not crop and row_len >= width:
+                finish_row(row, row_len)
+                row = []
+                row_len = 0
+
+        data = data[pos:]
+        for finished in done:
+            yield finished
+        del done[:]
+
+    finish_row(row, row_len)
+    yield done.pop()
+
+def read_rows(f, width=80, crop=False, chunk_size=65536):
+    """
+        As read_runs, but yielding rows of [fg, bg, character] cells, as used by list-backed Buffers.
+    """
+    for runs in read_runs(f, width=width, crop=crop, chunk_size=chunk_size):
+        yield [[fg, bg, c] for fg, bg, text in runs for c in text]
+
+def read_planes(rows, width, planes_type=buffer.cells.CellPlanes):
+    """
+        Pack rows from read_runs into cell planes, a run at a time.
+        Any cells past width are dropped.
+    """
+    fg_parts, bg_parts, ch_parts = [], [], []
+    height = 0
+    for runs in rows:
+        space = width
+        for fg, bg, text in runs:
+            text = text[:space]
+            fg_parts.append(chr(fg) * len(text))
+            bg_parts.append(chr(bg) * len(text))
+            ch_parts.append(text)
+            space -= len(text)
+            if space <= 0:
+                break
+        height += 1
+    return planes_type(width, height,
+        fg=bytearray(''.join(fg_parts)), bg=bytearray(''.join(bg_parts)), ch=bytearray(''.join(ch_parts)))
+
+def read_to_buffer(f, width=80, max_height=None, crop=False, storage='list'):
+    """
+        Read ANSI art from a file-like object into a Buffer. See read_runs.
+        Reading stops once there are max_height rows.
+
+        storage:
+            As for Buffer. With 'array' or 'numpy', the cells are packed straight into planes,
+            which is much quicker for big files.
+    """
+    if storage in buffer.planes_types:
+        rows = read_runs(f, width=width, crop=crop)
+    else:
+        rows = read_rows(f, width=width, crop=crop)
     if max_height:
-        rows = rows[:max_height]
+        rows = itertools.islice(rows, max_height)
+
+    if storage in buffer.planes_types:
+        data = read_planes(rows, width, buffer.planes_types[storage])
+        height = data.height
+    else:
+        data = list(rows)
+        height = len(data)
     buf = buffer.Buffer(
-        width=width, height=len(rows),
-        data=rows
+        width=width, height=height,
+        data=data, storage=storage
     )
     return buf
+
+#The escapes and line breaks that token_re finds, without the text in between.
+#finditer skips over the text, so the escapes come out exactly as read_runs sees them.
+#Unlike read_runs, a \r\n is one line break.
+break_re = re.compile(r'\x1b(?:\[([0-9;]*)([^0-9;])|(O.)|([^\[O]))|(\r\n?|\n)', re.S)
+
+class MappedRows(collections.Sequence):
+    """
+        The rows of some ANSI art, decoded only when they're asked for.
+
+        Creating one makes a single pass over the data, recording where each row starts
+        and what the colors are at that point. After that, any row can be decoded on its
+        own with read_runs, so opening a huge file is quick, and only the rows something
+        looks at (like a BufferView scrolling over them) are ever turned into cells.
+
+        Rows are split as read_runs splits them, except that a \r\n line ending
+        is one break rather than two, so files with CRLF line endings get one row per line.
+
+        data:
+            The art, as a string or an mmap (see map_to_buffer).
+        width:
+        crop:
+            As for read_runs.
+        offset:
+            Where the art starts in data, to skip a header.
+        max_rows:
+            If set, only keep this many decoded rows around, dropping the least
+            recently used. They're decoded again if they're needed.
+            Rows that have been changed are pinned, and never dropped: rows that are
+            assigned, or changed with MappedBuffer.set_at. Anything that changes a row's
+            cells some other way should pin() it.
+    """
+    def __init__(self, data, width=80, crop=False, offset=0, max_rows=None):
+        self.data = data
+        self.width = width
+        self.crop = crop
+        self.rows = lru.LRUCache(max_rows)
+        #rows that have been changed, which can't be decoded again
+        self.pinned = {}
+        self.index_rows(offset)
+
+    def index_rows(self, offset):
+        """
+            Find the start of each row, as (offset, fg, bg, bold, last_color).
+        """
+        global bold, last_color
+        data, width, crop = self.data, self.width, self.crop
+        end = len(data)
+        fg = term.colors.WHITE
+        bg = term.colors.BLACK
+        #escapes change the bold/last color globals, so keep our own copy, and only
+        #hand it to escape_meaning when there's a sequence we haven't seen in this state
+        saved = bold, last_color
+        state = saved
+        meanings = {}
+        starts = [(offset, fg, bg) + state]
+        row_len = 0
+        pos = offset
+        for token in break_re.finditer(data, offset, end):
+            start = token.start()
+            if not crop:
+                #wrap the text before this token
+                text_len = start - pos
+                fill = width - row_len
+                while text_len >= fill:
+                    pos += fill
+                    text_len -= fill
+                    starts.append((pos, fg, bg) + state)
+                    row_len = 0
+                    fill = width
+                row_len += text_len
+            pos = token.end()
+
+            args, command, o_command, other, newline = token.groups()
+            if newline is not None:
+                starts.append((pos, fg, bg) + state)
+                row_len = 0
+                continue
+            if other is not None:
+                #a lone ESC, which read_runs ignores
+                continue
+
+            key = (args, command or o_command) + state
+            meaning = meanings.get(key)
+            if meaning is None:
+                bold, last_color = state
+                if command is not None:
+                    esc = escape_meaning([int(arg) for arg in args.split(';') if arg], command)
+                else:
+                    esc = escape_meaning([], o_command)
+                meaning = meanings[key] = (esc.meaning, esc.value, esc.fg, esc.bg, (bold, last_color))
+
+            esc_meaning, value, esc_fg, esc_bg, state = meaning
+            if esc_meaning == 'right':
+                row_len += value
+                if not crop and row_len >= width:
+                    starts.append((pos, fg, bg) + state)
+                    row_len = 0
+            elif esc_meaning == 'color':
+                if esc_fg is not None:
+                    fg = esc_fg
+                if esc_bg is not None:
+                    bg = esc_bg
+
+        #read_runs gives up at an escape sequence that never finishes
+        unfinished = data.find('\x1b', pos, end)
+        if unfinished != -1:
+            end = unfinished
+        if not crop:
+            #and any text after the last one
+            text_len = end - pos
+            fill = width - row_len
+            while text_len >= fill:
+                pos += fill
+                text_len -= fill
+                starts.append((pos, fg, bg) + state)
+                fill = width
+
+        bold, last_color = saved
+        self.starts = starts
+        self.end = end
+
+    def decode(self, index):
+        """
+            Decode a row from the data into [fg, bg, character] cells.
+        """
+        global bold, last_color
+        start, fg, bg, row_bold, row_last_color = self.starts[index]
+        if index + 1 < len(self.starts):
+            end = self.starts[index + 1][0]
+        else:
+            end = self.end
+
+        saved = bold, last_color
+        bold, last_color = row_bold, row_last_color
+        try:
+            f = cStringIO.StringIO(self.data[start:end])
+            runs = next(read_runs(f, width=self.width, crop=self.crop, fg=fg, bg=bg))
+        finally:
+            bold, last_color = saved
+        return [[run_fg, run_bg, c] for run_fg, run_bg, text in runs for c in text]
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in xrange(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("MappedRows index out of range")
+
+        row = self.pinned.get(index)
+        if row is None:
+            row = self.rows.get(index)
+        if row is None:
+            row = self.decode(index)
+            self.rows.put(index, row)
+        return row
+
+    def __setitem__(self, index, row):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("MappedRows index out of range")
+        self.rows.pop(index)
+        self.pinned[index] = row
+
+    def pin(self, index):
+        """
+            Keep a row that's been changed, rather than letting max_rows drop it.
+        """
+        self.pinned[index] = self[index]
+        self.rows.pop(index)
+
+    def __repr__(self):
+        return "<MappedRows: %d rows, %d decoded, %d pinned>" % (len(self), len(self.rows), len(self.pinned))
+
+class MappedBuffer(buffer.Buffer):
+    """
+        A Buffer holding MappedRows, so its cells are only decoded as they're used.
+        Drawing the whole thing decodes every row, so it's best used as the parent of a BufferView.
+    """
+    def __init__(self, rows, **kwargs):
+        buffer.Buffer.__init__(self, width=rows.width, height=len(rows), data=rows, **kwargs)
+
+    def set_at(self, x, y, char=None, fg=None, bg=None):
+        buffer.Buffer.set_at(self, x, y, char, fg, bg)
+        self._data.pin(y)
+
+    def _check_data(self):
+        #looking at every row would decode them all
+        if len(self._data) < self.height:
+            raise ValueError("Buffer data has %r rows, but a specified height of %r" % (len(self._data), self.height))
+        return True
+
+def map_to_buffer(filename, width=80, crop=False, offset=0, max_rows=None):
+    """
+        Open ANSI art as a MappedBuffer, with the file memory-mapped rather than read in,
+        so only the rows that get used are decoded (see MappedRows).
+        offset skips that many bytes at the start of the file.
+    """
+    f = open(filename, 'rb')
+    try:
+        if os.fstat(f.fileno()).st_size:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            #an empty file can't be mapped
+            data = ''
+    finally:
+        #the map stays valid without the file
+        f.close()
+    return MappedBuffer(MappedRows(data, width=width, crop=crop, offset=offset, max_rows=max_rows))
@@ -1,15 +1,25 @@
 import re
+import bisect
 import collections
 import math
 import logging
 import boxtypes
 import term
+import cells
+import lru
 
 __license__ = "BSD"
 __all__ = ['Buffer', 'BaseText', 'PlainText', 'RichText', 'Box', 'MessageBox']
 
 log = logging.getLogger('pytality.buffer')
 
+#The planes class used for each compact storage mode.
+#numpy storage falls back to plain arrays when numpy isn't installed.
+planes_types = {
+    'array': cells.CellPlanes,
+    'numpy': cells.NumpyCellPlanes if cells.numpy is not None else cells.CellPlanes,
+}
+
 class Buffer(object):
     """
     A buffer on the screen, representing a rectangular block of cells.
@@ -17,11 +27,15 @@ class Buffer(object):
 
     This class can be used directly if you want to manually manage the cell data.
     """
+    #Whether drawing this buffer paints every cell in its rectangle.
+    #Opaque buffers let Buffer.draw skip earlier siblings that they completely cover.
+    opaque = True
+
     def __init__(self, width, height,
                 data=None,
                 x=0, y=0,
                 padding_x=0, padding_y=0,
-                children=None):
+                children=None, storage='list'):
         """
         Create a screen buffer.
         Mandatory arguments:
@@ -55,16 +69,32 @@ class Buffer(object):
 
         children:
             A list of child buffers to draw after this buffer is drawn.
+
+        storage:
+            How the cell data is stored.
+            'list' (the default) keeps the [fg, bg, character] lists described above.
+            'array' packs the cells into flat cells.CellPlanes bytearrays, which is
+            much smaller and faster to create. _data is then a list-like view of
+            the planes, so existing code reading or writing it keeps working.
+            'numpy' is like 'array', but the planes are also available as uint8
+            numpy arrays, and backends can copy them with vectorized blits.
+            It falls back to 'array' if numpy is not installed.
             
         """
         self.width = width
         self.height = height
+        self.storage = storage
 
         if data is None:
             self._reset_data()
+        elif isinstance(data, cells.CellPlanes):
+            self._data = data.data
         else:
             self._data = data
         self._check_data()
+
+        if storage in planes_types and self._planes is None:
+            self._data = planes_types[storage].from_rows(self._data, width, height).data
         
         self.padding_x = padding_x
         self.padding_y = padding_y
@@ -92,6 +122,30 @@ class Buffer(object):
         self._y = value
         self.dirty = True
 
+    @property
+    def dirty(self):
+        return self._dirty
+
+    @dirty.setter
+    def dirty(self, value):
+        #setting dirty directly always means 'redraw everything'
+        self._dirty = value
+        self.damage = None
+
+    @property
+    def _data(self):
+        return self._cells
+
+    @_data.setter
+    def _data(self, value):
+        #keep track of whether we're looking at compact planes or plain lists
+        self._cells = value
+        if isinstance(value, cells.PlaneData):
+            self._planes = value.planes
+        else:
+            self._planes = None
+        self.dirty = True
+
     @property
     def inner_width(self):
         return self.width - (self.padding_x*2)
@@ -100,11 +154,42 @@ class Buffer(object):
     def inner_height(self):
         return self.height - (self.padding_y*2)
 
+    def mark_damaged(self, x, y, width=1, height=1):
+        """
+        Mark a rectangle of cells as changed, so that the next draw only
+        redraws those cells (and any children overlapping them).
+
+        The damage is kept in self.damage, as a dict of {row: [start_x, end_x]} spans.
+        If the whole buffer is already dirty, this does nothing.
+        """
+        if self._dirty and self.damage is None:
+            return
+        if not self._dirty:
+            self._dirty = True
+            self.damage = {}
+
+        spans = self.damage
+        end_x = x + width
+        for row in range(y, y + height):
+            span = spans.get(row)
+            if span is None:
+                spans[row] = [x, end_x]
+            else:
+                if x < span[0]:
+                    span[0] = x
+                if end_x > span[1]:
+                    span[1] = end_x
+
     def set_at(self, x, y, char=None, fg=None, bg=None):
         """
         Modify the properties of a cell at (x, y).
-        Also dirties the buffer for the next draw.
+        Also marks the cell as damaged for the next draw.
         """
+        if self._planes is not None:
+            self._planes.set(x, y, fg, bg, char)
+            self.mark_damaged(x, y)
+            return
+
         #copy it! shared references can do hilarious things
         cell = self._data[y][x][:]
         if fg is not None:
@@ -114,25 +199,128 @@ class Buffer(object):
         if char is not None:
             cell[2] = char
         self._data[y][x] = cell
-        self.dirty = True
+        self.mark_damaged(x, y)
 
-    def draw(self, x_offset=0, y_offset=0, dirty=False):
+    def draw(self, x_offset=0, y_offset=0, dirty=False, target=term):
+        """
+        Draw this buffer and its children, if they need it.
+
+        target:
+            Where to draw to - anything with a draw_buffer(buf, x, y) function.
+            Defaults to the terminal. See compositor.Compositor.
+        """
         #xoff and yoff are screen offsets from our parent.
         x_offset = x_offset + self._x
         y_offset = y_offset + self._y
-        if self.dirty:
-            dirty = True
+
+        #remember where we are on the screen, and whether any of it is visible
+        self.screen_rect = (x_offset, y_offset, x_offset + self.width, y_offset + self.height)
+        visible = self.width > 0 and self.height > 0
+        screen_size = getattr(target, 'size', None)
+        if visible and screen_size:
+            visible = (x_offset < screen_size[0] and y_offset < screen_size[1] and
+                        self.screen_rect[2] > 0 and self.screen_rect[3] > 0)
 
         #log.debug("%r dirty=%r, x_offset=%r, y_offset=%r", self, dirty, x_offset, y_offset)
         #put ourselves on the screen
-        if dirty:
-            term.draw_buffer(self, x_offset, y_offset)
+        damage = None
+        if dirty or (self._dirty and self.damage is None):
+            dirty = True
+            if visible:
+                target.draw_buffer(self, x_offset, y_offset)
+            else:
+                #nothing of ours would reach the screen
+                self.dirty = False
+
+        elif self._dirty:
+            #only some cells changed, so only redraw those
+            damage = self._damage_rects()
+            if not visible:
+                damage = None
+                self.dirty = False
+            elif sum([w * h for _, _, w, h in damage]) * 2 > self.width * self.height:
+                #not worth the trouble
+                dirty = True
+                target.draw_buffer(self, x_offset, y_offset)
+            else:
+                for x, y, w, h in damage:
+                    target.draw_buffer(Region(self, x, y, w, h), x_offset + x, y_offset + y)
+                self.dirty = False
 
         #have our children do similar
-        for child in self.children:
-            child.draw(x_offset + self.padding_x, y_offset + self.padding_y, dirty)
+        children = self.children
+        for i, child in enumerate(children):
+            child_dirty = self._child_needs_redraw(child, dirty, damage)
+            if not child.children and (child_dirty or child._dirty) and self._child_covered(i, dirty, damage):
+                #a later sibling is about to paint over all of it anyway
+                child.dirty = False
+                continue
+            child.draw(x_offset + self.padding_x, y_offset + self.padding_y, child_dirty, target)
+
+    def _child_needs_redraw(self, child, dirty, damage):
+        """
+        Work out whether drawing ourselves has painted over a child,
+        meaning it has to be redrawn in full.
+        """
+        if dirty:
+            return True
+        if damage:
+            #we painted over part of the screen, so children in that part need to redraw
+            child_x = self.padding_x + child._x
+            child_y = self.padding_y + child._y
+            for x, y, w, h in damage:
+                if (child_x < x + w and x < child_x + child.width and
+                    child_y < y + h and y < child_y + child.height):
+                    return True
+        return False
+
+    def _child_covered(self, index, dirty, damage):
+        """
+        Check whether the child at index will be completely painted over
+        by a later, opaque sibling during this draw.
+        """
+        children = self.children
+        child = children[index]
+        x0, y0 = child._x, child._y
+        x1, y1 = x0 + child.width, y0 + child.height
+        for i in range(index + 1, len(children)):
+            sibling = children[i]
+            if not sibling.opaque:
+                continue
+            if (sibling._x > x0 or sibling._y > y0 or
+                sibling._x + sibling.width < x1 or sibling._y + sibling.height < y1):
+                continue
+            if (sibling._dirty and sibling.damage is None) or self._child_needs_redraw(sibling, dirty, damage):
+                return True
+        return False
+
+    def _damage_rects(self):
+        """
+        Turn our damaged row spans into a list of (x, y, width, height) rectangles,
+        clipped to the buffer. Rows with identical spans are merged together.
+        """
+        rects = []
+        last = None
+        for row in sorted(self.damage):
+            if not 0 <= row < self.height:
+                continue
+            x0, x1 = self.damage[row]
+            x0 = max(0, x0)
+            x1 = min(self.width, x1)
+            if x0 >= x1:
+                continue
+            if last is not None and last[0] == x0 and last[2] == x1 - x0 and last[1] + last[3] == row:
+                last[3] += 1
+            else:
+                last = [x0, row, x1 - x0, 1]
+                rects.append(last)
+        return rects
 
     def _reset_data(self):
+        if self.storage in planes_types:
+            self._data = planes_types[self.storage](self.width, self.height).data
+            return
+
         rows = []
         for y in range(self.height):
             row = []
@@ -147,6 +335,13 @@ class Buffer(object):
         If they do and this check is skipped, the resulting failure will be
         very far away from the source and hard to track down.
         """
+        if self._planes is not None:
+            #planes are well-formed by construction, so only the size can be wrong
+            if self._planes.width < self.width or self._planes.height < self.height:
+                raise ValueError("Buffer planes are %rx%r, but a specified size of %rx%r" % (
+                    self._planes.width, self._planes.height, self.width, self.height))
+            return True
+
         if not isinstance(self._data, collections.MutableSequence):
             raise ValueError("Buffer data must be a list (not a %r)" % type(self._data))
 
@@ -154,18 +349,64 @@ class Buffer(object):
             raise ValueError("Buffer data has %r rows, but a specified height of %r" % (len(self._data), self.height))
 
         for row in self._data:
-            if not isinstance(row, collections.MutableSequence):
+            #(plain lists are by far the most common, and much quicker to check for than the ABC)
+            if type(row) is not list and not isinstance(row, collections.MutableSequence):
                 raise ValueError("Buffer data rows must be lists (not a %r)" % type(row))
             if len(row) < self.width:
                 raise ValueError("Buffer data row has %r cells, but a specified width of %r" % (len(row), self.width))
             
             for cell in row:
-                if not isinstance(cell, collections.MutableSequence):
+                if type(cell) is not list and not isinstance(cell, collections.MutableSequence):
                     raise ValueError("Buffer data cells must be lists (not a %r)" % type(cell))
                 if len(cell) < 3:
                     raise ValueError("Buffer data cells must have 3 items (fg, bg, char), not %r" % (len(cell)))
         return True
 
+class Region(object):
+    """
+    A rectangle of another buffer's cells, which can be drawn by term.draw_buffer
+    in the same way as a buffer. Used to redraw just the damaged parts of a buffer.
+    """
+    def __init__(self, source, x, y, width, height):
+        self.width = width
+        self.height = height
+        self.dirty = True
+        if source._planes is not None:
+            self._planes = source._planes.window(x, y, width, height)
+            self._data = self._planes.data
+        else:
+            self._planes = None
+            self._data = [row[x:x + width] for row in source._data[y:y + height]]
+
+class RowRange(collections.Sequence):
+    """
+    Rows start:end of some buffer data, as a view rather than a copy.
+    """
+    def __init__(self, rows, start, end):
+        self.rows = rows
+        self.start = start
+        self.end = end
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.rows[i] for i in range(self.start, self.end)[index]]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("RowRange index out of range")
+        return self.rows[self.start + index]
+
+    def __iter__(self):
+        rows = self.rows
+        for i in xrange(self.start, self.end):
+            yield rows[i]
+
+    def __repr__(self):
+        return repr(self[:])
+
 #-----------------------------------------------------------------------------
 
 class BaseText(Buffer):
@@ -199,10 +440,41 @@ class BaseText(Buffer):
         'render' the current message into buffer data.
         
         This function is expected to set self.width, self.height, self._data,
-        and possibly set self.dirty.
+        and possibly set self.dirty - usually by calling update_rows().
         """
         raise NotImplemented()
 
+    def update_rows(self, rows, width):
+        """
+        Replace the buffer data with newly rendered rows.
+
+        If the size hasn't changed, the current rows are kept and only the cells
+        that differ are copied over and marked as damaged, so a counter that
+        changes one digit only redraws that digit.
+        """
+        height = len(rows)
+        if getattr(self, '_cells', None) is None or width != self.width or height != self.height:
+            self.width = width
+            self.height = height
+            #(storage isn't set yet while the text is first being made - Buffer.__init__ packs it)
+            storage = getattr(self, 'storage', 'list')
+            if storage in planes_types:
+                self._data = planes_types[storage].from_rows(rows, width, height).data
+            else:
+                self._data = rows
+            return
+
+        data = self._data
+        for y, row in enumerate(rows):
+            old_row = data[y][:width]
+            if old_row == row:
+                continue
+            changed = [x for x in range(width) if old_row[x] != row[x]]
+            target = data[y]
+            for x in changed:
+                target[x] = row[x]
+            self.mark_damaged(changed[0], y, changed[-1] - changed[0] + 1)
+
 class PlainText(BaseText):
     """
     A buffer representing simple text.
@@ -234,7 +506,6 @@ class PlainText(BaseText):
         BaseText.__init__(self, message, **kwargs)
 
     def update_data(self):
-        row = []
         msg = self.message
         if self.center_to:
             msg = msg.center(self.center_to)
@@ -242,13 +513,8 @@ class PlainText(BaseText):
         if self.max_width:
             msg = msg[:self.max_width]
         
-        for c in msg:
-           row.append([self.fg, self.bg, c])
-
-        self.width = len(row)
-        self.height = 1
-        self._data = [row]
-        self.dirty = True
+        fg, bg = self.fg, self.bg
+        self.update_rows([[[fg, bg, c] for c in msg]], len(msg))
 
 class RichText(BaseText):
     """
@@ -263,14 +529,39 @@ class RichText(BaseText):
     The current colors are tracked in a stack; </> pops down the color stack.
 
     It might be interesting to implement other commands like <CENTER> later.
+
+    format() doesn't parse the markup every time: the base message is compiled once
+    into a template with the colors already worked out, and only the text between
+    the markup is filled in.
     """
     colorRE = re.compile(r'([^<]*)<([\w]*|/)>')
 
-    def __init__(self, message, wrap_to=None, initial_color=term.colors.LIGHTGREY, bg=term.colors.BLACK, **kwargs):
+    #Separates the pieces of a compiled template, so one % fills them all in.
+    part_separator = '\0'
+
+    #Rendered messages, across all RichTexts - set row_cache.max_size to turn it on.
+    #Text that keeps being set to the same few messages can then skip rendering.
+    #Off (0) by default.
+    row_cache = lru.LRUCache(0)
+
+    #Word wrapped line breaks of recent messages, across all RichTexts.
+    #measure() and rendering share them, so a message is only broken into lines once.
+    break_cache = lru.LRUCache(1024)
+
+    def __init__(self, message, wrap_to=None, initial_color=term.colors.LIGHTGREY, bg=term.colors.BLACK,
+                word_wrap=False, hyphenate=False, **kwargs):
         """
         wrap_to:
             Wrap the message at a maximum of N characters in width.
-            No special logic is performed for tracking words or hyphenating.
+            By default lines are simply chopped every N characters.
+
+        word_wrap:
+            Break wrapped lines between words (or after a '-') instead.
+            The spaces a line is broken at are dropped.
+            Words too long for a line of their own are still chopped.
+
+        hyphenate:
+            With word_wrap, put a '-' where a long word gets chopped.
 
         initial_color:
             The foreground color that the message will start out as.
@@ -283,34 +574,79 @@ class RichText(BaseText):
         self.wrap_to = wrap_to
         self.initial_color = initial_color
         self.bg = bg
+        self.word_wrap = word_wrap
+        self.hyphenate = hyphenate
+        #(base_message, initial_color) and the template compiled from them
+        self.compiled_key = None
+        self.compiled = None
         BaseText.__init__(self, message, **kwargs)
 
-    def update_data(self):
+    def format(self, fmt):
+        compiled = self.compile()
+        if compiled is None:
+            return BaseText.format(self, fmt)
+
+        template, colors = compiled
+        pieces = (template % fmt).split(self.part_separator)
+        message = ''.join(pieces)
+        if len(pieces) != len(colors) * 2 - 1 or message.count('<') != len(colors) - 1:
+            #the values filled in had markup (or separators) of their own, so it has to be parsed properly
+            self.message = self.base_message % fmt
+            self.update_data()
+            return
+
+        self.message = message
+        texts = pieces[::2]
+        texts[-1] = texts[-1].rstrip('\n')
+        self.update_data([part for part in zip(colors, texts) if part[1]])
+
+    def update_data(self, message_parts=None):
+        cache_size = self.row_cache.max_size
+        if cache_size:
+            key = (self.message, self.wrap_to, self.initial_color, self.bg, self.word_wrap, self.hyphenate)
+            cached = self.row_cache.get(key)
+            if cached is not None:
+                width, rows = cached
+                #a copy, so set_at on this text can't change the cached rows
+                self.update_rows([row[:] for row in rows], width)
+                return
+
+        if message_parts is None:
+            message_parts = self.parse()
+        bg = self.bg
         rows = []
         row = []
-        message_parts = self.parse()
-        
+
         #build
         for part_color, part_text in message_parts:
-            for c in part_text:
-                if c == '\n':
-                    rows.append(row)
-                    row = []
-                    continue
-                row.append([part_color, self.bg, c])
+            lines = part_text.split('\n')
+            row.extend([[part_color, bg, c] for c in lines[0]])
+            for line in lines[1:]:
+                rows.append(row)
+                row = [[part_color, bg, c] for c in line]
         
         rows.append(row)
 
         #wrap
-        if self.wrap_to:
+        if self.wrap_to and self.word_wrap:
+            text = ''.join([part_text for part_color, part_text in message_parts])
+            breaks = self.line_breaks(self.message, self.wrap_to, self.hyphenate, text)
+            new_rows = []
+            for row, row_breaks in zip(rows, breaks):
+                for start, end, hyphen in row_breaks:
+                    chunk = row[start:end]
+                    if hyphen:
+                        #the hyphen takes on the color of the word it splits
+                        chunk.append([chunk[-1][0], bg, '-'])
+                    new_rows.append(chunk)
+            rows = new_rows
+        elif self.wrap_to:
             width = self.wrap_to
             new_rows = []
             for row in rows:
                 if len(row) > width:
-                    wrapped_data = []
                     for i in range(0, len(row), width):
-                        chunk = row[i:i+width]
-                        new_rows.append(chunk)
+                        new_rows.append(row[i:i+width])
                 else:
                     new_rows.append(row)
             rows = new_rows
@@ -321,35 +657,176 @@ class RichText(BaseText):
         else:
             width = max([len(r) for r in rows])
         for row in rows:
-            while len(row) < width:
-                row.append([self.bg, self.bg, ' '])
-        
+            if len(row) < width:
+                row.extend([[bg, bg, ' '] for i in range(width - len(row))])
         
+        if cache_size:
+            self.row_cache.put(key, (width, rows))
+            rows = [row[:] for row in rows]
+
         #finish
-        self.width = width
-        self.height = len(rows)
-        #log.debug("text w=%r, h=%r, part0=%r", self.width, self.height, message_parts[0] if message_parts else None)
-        self._data = rows
-        self.dirty = True
+        #log.debug("text w=%r, h=%r, part0=%r", width, len(rows), message_parts[0] if message_parts else None)
+        self.update_rows(rows, width)
 
     def parse(self):
-        raw_msg = self.message.rstrip('\n')
-        raw_parts = filter(None, self.colorRE.split(raw_msg))
+        return self.split_markup(self.message, self.initial_color)
+
+    def compile(self):
+        """
+        Get the compiled template for the current base message,
+        compiling it if that hasn't been done yet.
+        """
+        key = (self.base_message, self.initial_color)
+        if key != self.compiled_key:
+            self.compiled_key = key
+            self.compiled = self.compile_markup(self.base_message, self.initial_color)
+        return self.compiled
+
+    @classmethod
+    def compile_markup(cls, message, initial_color):
+        """
+        Turn a message into a (template, colors) pair.
+        The template is the message with part_separator around each piece of markup,
+        so once it's been %-formatted, splitting it on part_separator gives
+        text, markup, text, markup, ..., text. colors has the color of each text piece.
+
+        Returns None for messages that can't be compiled, like ones containing a '<'
+        that isn't markup, or markup that isn't a color. Those are parsed as usual.
+        """
+        sep = cls.part_separator
+        if sep in message:
+            return None
+        pieces = []
+        colors = []
+        color_stack = [initial_color]
+        pos = 0
+        for match in cls.colorRE.finditer(message):
+            if match.start() != pos:
+                #a stray '<' was skipped over
+                return None
+            text, command = match.groups()
+            pieces.append(text)
+            colors.append(color_stack[-1])
+            if command == '/':
+                if len(color_stack) == 1:
+                    return None
+                color_stack.pop()
+            elif command and hasattr(term.colors, command):
+                color_stack.append(getattr(term.colors, command))
+            else:
+                return None
+            pieces.append(message[match.end(1):match.end()])
+            pos = match.end()
+
+        rest = message[pos:]
+        if '<' in rest:
+            return None
+        pieces.append(rest)
+        colors.append(color_stack[-1])
+        return sep.join(pieces), colors
+
+    @classmethod
+    def split_markup(cls, message, initial_color):
+        """
+        Split a message into a list of (color, text) parts.
+        """
+        raw_msg = message.rstrip('\n')
+        #split() gives text between matches, text, command, text between matches, ...
+        raw_parts = cls.colorRE.split(raw_msg)
         message_parts = []
-        color_stack = [self.initial_color]
-        for part in raw_parts:
-            if part == '/':
+        color_stack = [initial_color]
+        for i, part in enumerate(raw_parts):
+            if not part:
+                continue
+            if i % 3 != 2:
+                #it's a text component
+                message_parts.append((color_stack[-1], part))
+            elif part == '/':
                 #go back a color
                 color_stack.pop()
             elif hasattr(term.colors, part):
                 #push a new color
                 color_stack.append(getattr(term.colors, part))
             else:
-                #it's a text component
+                #not a color we know, so show it as it is
                 message_parts.append((color_stack[-1], part))
         #log.debug("parts: %r", message_parts)
         return message_parts
 
+    @classmethod
+    def measure(cls, message, wrap_to=None, initial_color=term.colors.LIGHTGREY, word_wrap=False, hyphenate=False):
+        """
+        Work out how many rows a message will be, without rendering it.
+        """
+        if wrap_to and word_wrap:
+            key = (message, wrap_to, hyphenate)
+            if key not in cls.break_cache:
+                text = ''.join([part_text for part_color, part_text in cls.split_markup(message, initial_color)])
+            else:
+                text = None
+            return sum([len(row_breaks) for row_breaks in cls.line_breaks(message, wrap_to, hyphenate, text)])
+
+        text = ''.join([part_text for part_color, part_text in cls.split_markup(message, initial_color)])
+        lines = text.split('\n')
+        if not wrap_to:
+            return len(lines)
+        #lines longer than wrap_to are chopped into wrap_to-sized rows
+        return sum([max(1, (len(line) + wrap_to - 1) // wrap_to) for line in lines])
+
+    @classmethod
+    def line_breaks(cls, message, wrap_to, hyphenate, text):
+        """
+        Get where a message's lines are word wrapped, from the cache if it's there.
+        text is the message with its markup taken out - it's only needed if it isn't cached.
+
+        Returns a list with an entry for each line of the message: a list of
+        (start, end, hyphenated) for each row that line is wrapped into.
+        """
+        key = (message, wrap_to, hyphenate)
+        breaks = cls.break_cache.get(key)
+        if breaks is None:
+            breaks = [cls.break_line(line, wrap_to, hyphenate) for line in text.split('\n')]
+            cls.break_cache.put(key, breaks)
+        return breaks
+
+    @staticmethod
+    def break_line(line, width, hyphenate=False):
+        """
+        Word wrap one line of text to width, returning (start, end, hyphenated) for each row.
+        Rows break at the last space or after the last '-' that fits.
+        A word with neither is chopped, with room left for a hyphen if hyphenate is set.
+        """
+        length = len(line)
+        if length <= width:
+            return [(0, length, False)]
+
+        breaks = []
+        start = 0
+        while length - start > width:
+            end = start + width
+            #a space just past the end of the row is fine to break at, too
+            space = line.rfind(' ', start, end + 1)
+            dash = line.rfind('-', start, end)
+            if space > start and space > dash:
+                breaks.append((start, space, False))
+                #the spaces at the break don't start the next row
+                start = space + 1
+                while start < length and line[start] == ' ':
+                    start += 1
+            elif dash > start:
+                breaks.append((start, dash + 1, False))
+                start = dash + 1
+            elif hyphenate and width > 1:
+                breaks.append((start, end - 1, True))
+                start = end - 1
+            else:
+                breaks.append((start, end, False))
+                start = end
+
+        if start < length or not breaks:
+            breaks.append((start, length, False))
+        return breaks
+
 
 #-----------------------------------------------------------------------------
 
@@ -455,16 +932,33 @@ class MessageBox(Box):
     MessageBuffers act as Box buffers that automatically manage their children. Consequently,
     modifications to .children will be lost.
 
+    Messages are kept as their markup, and only rendered into RichText when they
+    scroll into view; the most recently shown render_cache_size of them are kept around.
+
     cursor_offset:
     cursor_boxtype:
     cursor_fg_color:
     autoscroll:
+
+    max_messages:
+    max_lines:
+        If set, the oldest messages are dropped once the log holds more than this many
+        messages or lines, so long-running logs don't grow forever.
+        The newest message is always kept.
+
+    word_wrap:
+    hyphenate:
+        How messages are wrapped - see RichText.
     """
+    render_cache_size = 128
+
     def __init__(self,
                 width, height,
                 padding_x=1, padding_y=1,
                 scrollbar_type="edge", scrollbar_fg_color=term.colors.WHITE,
                 auto_scroll=True,
+                max_messages=None, max_lines=None,
+                word_wrap=False, hyphenate=False,
                 **kwargs):
         
         Box.__init__(self,
@@ -472,9 +966,25 @@ class MessageBox(Box):
             padding_x=padding_x, padding_y=padding_y,
             **kwargs)
         
+        #the markup of each message
         self.messages = []
+        #the line each message ends on, cumulatively: line_ends[i] is the total height of messages[:i+1]
+        #plus first_line, the number of lines that have been dropped from the start of the log.
+        self.line_ends = []
+        self.first_line = 0
+        #how many messages have been dropped from the start of the log
+        self.first_message = 0
+        #RichText for recently shown messages, by message number (counting dropped ones)
+        self.rendered = lru.LRUCache(self.render_cache_size)
+        self.needs_layout = True
+        #how many rows of the box were filled with messages at the last layout
+        self.covered_rows = 0
         self.offset = 0
         self.auto_scroll = auto_scroll
+        self.max_messages = max_messages
+        self.max_lines = max_lines
+        self.word_wrap = word_wrap
+        self.hyphenate = hyphenate
 
         #setup our sub-buffers
         #the scroll cursor
@@ -485,6 +995,7 @@ class MessageBox(Box):
 
         self.scroll_cursor = scroll_cursor
         self.scrollbar_offset = scroll_cursor.right_margin
+        self.wrap_to = self.inner_width - max(0, self.scrollbar_offset)
 
         #'partial' message buffers for linewrapped messages
         self.top_partial_message = Buffer(self.inner_width, 1)
@@ -497,13 +1008,19 @@ class MessageBox(Box):
         if scroll is None:
             scroll = self.auto_scroll
 
-        message = RichText(msg, wrap_to=self.inner_width - max(0, self.scrollbar_offset))
-        self.messages.append(message)
+        self.messages.append(msg)
+        height = RichText.measure(msg, wrap_to=self.wrap_to, word_wrap=self.word_wrap, hyphenate=self.hyphenate)
+        self.line_ends.append(self.first_line + self.total_lines + height)
+
+        #keep the view on the same lines if the start of the log goes away
+        removed = self.trim()
+        if removed:
+            self.offset = max(0, self.offset - removed)
 
         if scroll:
             self.scroll(end=True)
         else:
-            self.recalculate_buffers()
+            self.invalidate_layout()
 
     def scroll(self, delta=0, home=False, end=False):
         """
@@ -517,7 +1034,7 @@ class MessageBox(Box):
         end:
             Scroll to the bottom of the log (as in the end key)
         """
-        total_lines = sum([msg.height for msg in self.messages])
+        total_lines = self.total_lines
 
         if home:
             offset = 0
@@ -535,25 +1052,83 @@ class MessageBox(Box):
         if offset < 0:
             offset = 0
         self.offset = offset
-        self.recalculate_buffers()
+        self.invalidate_layout()
+
+    def invalidate_layout(self):
+        """
+        Note that the visible messages need working out again before the next draw.
+        Deferring it means adding lots of messages at once only lays out (and renders) the last screenful.
+        """
+        self.needs_layout = True
+
+    def draw(self, *args, **kwargs):
+        if self.needs_layout:
+            self.recalculate_buffers()
+        Box.draw(self, *args, **kwargs)
+
+    def render(self, index):
+        """
+        Get the RichText for messages[index], rendering it if it isn't cached.
+        """
+        key = self.first_message + index
+        message = self.rendered.get(key)
+        if message is None:
+            message = RichText(self.messages[index], wrap_to=self.wrap_to,
+                               word_wrap=self.word_wrap, hyphenate=self.hyphenate)
+            self.rendered.put(key, message)
+        return message
+
+    def trim(self):
+        """
+        Drop the oldest messages until the log is within max_messages and max_lines.
+        Returns the number of lines dropped.
+        """
+        line_ends = self.line_ends
+        count = 0
+        if self.max_messages is not None:
+            count = len(self.messages) - self.max_messages
+        if self.max_lines is not None and self.total_lines > self.max_lines:
+            #keep everything after the last message that ends too far back
+            count = max(count, bisect.bisect_left(line_ends, line_ends[-1] - self.max_lines) + 1)
+        count = min(count, len(self.messages) - 1)
+        if count <= 0:
+            return 0
+
+        removed = line_ends[count - 1] - self.first_line
+        self.first_line = line_ends[count - 1]
+        self.first_message += count
+        del self.messages[:count]
+        del line_ends[:count]
+        return removed
+
+    @property
+    def total_lines(self):
+        """
+        The number of lines in all of the messages.
+        """
+        if not self.line_ends:
+            return 0
+        return self.line_ends[-1] - self.first_line
 
     def recalculate_buffers(self):
         """
         Recalculate the positioning and contents of message buffers for a new scroll offset.
+
+        Only what changed is marked for redrawing: messages that moved or just came into view,
+        the partial messages, and any parts of the box the scrollbar or messages have left.
         """
         def make_partial_message(msg, target, start=0, end=None, y=0):
-            msg_data = msg._data
             if end is None:
-                end = len(msg_data)
-
-            msg_data = msg_data[start:end]
-            target._data = msg_data
-            target.height = len(msg_data)
+                end = msg.height
+            #a view onto the message's rows, rather than a copy of them
+            target._data = RowRange(msg._data, start, end)
+            target.height = end - start
             target.width = msg.width
             target.y = y
 
         top_offset = self.offset
         bottom_offset = top_offset + self.inner_height
+        shown = set(self.children)
 
         #make our partial-messages invisible unless needed
         self.top_partial_message.width = 0
@@ -562,9 +1137,15 @@ class MessageBox(Box):
         self.bottom_partial_message.height = 0
 
         child_list = []
+        #skip straight to the first message that ends below the top of the view
+        first = bisect.bisect_right(self.line_ends, self.first_line + top_offset)
         #Keep track of our current, cumulative Y offset
-        lineno = 0
-        for message in self.messages:
+        lineno = (self.line_ends[first - 1] - self.first_line) if first else 0
+        for index in xrange(first, len(self.messages)):
+            if lineno >= bottom_offset:
+                #no further messages will be appearing
+                break
+            message = self.render(index)
             bottom = lineno + message.height
             if bottom > top_offset > lineno:
                 if bottom < bottom_offset:
@@ -579,14 +1160,18 @@ class MessageBox(Box):
 
             elif bottom > bottom_offset > lineno:
                 #this message crosses the bottom edge - we need to split it
-                make_partial_message(message, self.top_partial_message, 
+                make_partial_message(message, self.bottom_partial_message, 
                                     end=(bottom_offset - lineno), y=(lineno - top_offset))
 
             else:
                 if lineno >= top_offset and bottom <= bottom_offset:
                     #this message belongs in our list
                     new_y = (lineno - top_offset)
-                    message.y = new_y
+                    if message not in shown:
+                        #whatever is on screen there, it isn't this
+                        message.dirty = True
+                    if message.y != new_y:
+                        message.y = new_y
                     child_list.append(message)
 
                 else:
@@ -597,13 +1182,24 @@ class MessageBox(Box):
                     
             lineno = bottom
 
-        #update the scroll cursor
-        total_height = sum([m.height for m in self.messages])
-        self.scroll_cursor.reposition(top_offset, bottom_offset, total_height, self)
-
+        #update the scroll cursor, and repaint wherever it moved from
+        total_height = self.total_lines
+        cursor = self.scroll_cursor
+        old_cursor = (cursor.x, cursor.y, cursor.width, cursor.height)
+        cursor.reposition(top_offset, bottom_offset, total_height, self)
+        if old_cursor != (cursor.x, cursor.y, cursor.width, cursor.height):
+            x, y, width, height = old_cursor
+            self.mark_damaged(self.padding_x + x, self.padding_y + y, width, height)
+
+        #if there are fewer lines on screen than before, blank out the rest
+        covered_rows = max(0, min(self.inner_height, total_height - top_offset))
+        if covered_rows < self.covered_rows:
+            self.mark_damaged(self.padding_x, self.padding_y + covered_rows,
+                              self.inner_width, self.covered_rows - covered_rows)
+        self.covered_rows = covered_rows
 
         self.children = [self.scroll_cursor, self.top_partial_message] + child_list + [self.bottom_partial_message]
-        self.dirty = True
+        self.needs_layout = False
 
 class Scrollbar(PlainText):
     right_margin = 0
@@ -696,19 +1292,60 @@ class BufferView(Buffer):
     Provides the fields view_x and view_y; when drawn, the area to draw is offset
     by those coordinates.
 
-    Note that this does it's magic via __iter__, and thus mandates that future
-    term implementations use "
-        for row in _data:
-            for cell in row[:max_width]:
-    "
-    to iterate over buffers, which is currently true.
+    A view has no cells of its own. Its _data is the parent's rows, sliced down to
+    the visible rectangle when it's asked for - or if the parent is stored as planes,
+    _planes is a window onto them, which backends copy directly.
+    Either way, drawing a view costs about the same as drawing a plain buffer its size.
+
+    When the view scrolls, and the backend can move what's already on the screen
+    (see term.scroll_rect), only the newly uncovered rows and columns are drawn.
     """
+    #views don't paint anything past the edge of their parent
+    opaque = False
+
     def __init__(self, width, height, parent, view_x=0, view_y=0, **kwargs):
-        Buffer.__init__(self, width=width, height=height, **kwargs)
         self._view_x = view_x
         self._view_y = view_y
         self.parent = parent
-        self._data = self.DataView(self)
+        #how far the view has moved since it was drawn, if that's the only change
+        self.scroll_delta = None
+        Buffer.__init__(self, width=width, height=height, **kwargs)
+
+    @Buffer.dirty.setter
+    def dirty(self, value):
+        Buffer.dirty.fset(self, value)
+        #whatever it was, it wasn't just a scroll
+        self.scroll_delta = None
+
+    @property
+    def _data(self):
+        planes = self._planes
+        if planes is not None:
+            return planes.data
+        x, y = self._view_x, self._view_y
+        parent = self.parent
+        end_x = x + min(self.width, parent.width - x)
+        return [row[x:end_x] for row in parent._data[y:min(parent.height, y + self.height)]]
+
+    @_data.setter
+    def _data(self, value):
+        #there's nothing to store - just redraw
+        self.dirty = True
+
+    @property
+    def _planes(self):
+        planes = self.parent._planes
+        if planes is None:
+            return None
+        x, y = self._view_x, self._view_y
+        parent = self.parent
+        return planes.window(x, y, min(self.width, parent.width - x), min(self.height, parent.height - y))
+
+    def _reset_data(self):
+        self.dirty = True
+
+    def _check_data(self):
+        return True
 
     @property
     def view_x(self):
@@ -716,8 +1353,7 @@ class BufferView(Buffer):
 
     @view_x.setter
     def view_x(self, value):
-        self._view_x = value
-        self.dirty = True
+        self.move_view(value, self._view_y)
 
     @property
     def view_y(self):
@@ -725,8 +1361,7 @@ class BufferView(Buffer):
 
     @view_y.setter
     def view_y(self, value):
-        self._view_y = value
-        self.dirty = True
+        self.move_view(self._view_x, value)
 
     def scroll(self, x=0, y=0):
         x += self._view_x
@@ -739,55 +1374,44 @@ class BufferView(Buffer):
         y = max(0, y)
 
         log.debug("scroll: x=%r, y=%r", x, y)
+        self.move_view(x, y)
+
+    def move_view(self, x, y):
+        """
+        Point the view at (x, y) of the parent, working out what needs redrawing.
+        """
+        dx, dy = x - self._view_x, y - self._view_y
+        old_inside = self.inside_parent()
         self._view_x = x
         self._view_y = y
-        self.dirty = True
+        width, height = self.width, self.height
 
-    class DataView(list):
-        def __init__(self, buf):
-            self.buf = buf
-            super(BufferView.DataView, self).__init__(buf._data)
-
-        def __iter__(self):
-            return BufferView.RowIterator(self.buf)
+        #the scroll fast path needs the screen to be showing exactly our old view,
+        #and everything we'll be moving on to it to be in the parent
+        if (self._dirty or self.children or (not dx and not dy) or abs(dx) >= width or abs(dy) >= height
+                or not old_inside or not self.inside_parent()):
+            self.dirty = True
+            return
 
-    class RowIterator(collections.Iterator):
-        def __init__(self, buf):
-            super(BufferView.RowIterator, self).__init__()
-            self.buf = buf
-            self.idx = -1
-        
-        def next(self):
-            self.idx += 1
-            row_idx = self.buf._view_y + self.idx
-            if row_idx < self.buf.parent.height and row_idx < len(self.buf.parent._data):
-                val = self.buf.parent._data[row_idx]
-                return BufferView.CellIterator(self.buf, val)
-            else:
-                raise StopIteration()
-   
-    class CellIterator(collections.Iterator):
-        def __init__(self, buf, row):
-            super(BufferView.CellIterator, self).__init__()
-            self.buf = buf
-            self.row = row
-            self.idx = -1
-            self.start = 0
-            self.end = len(self.row)
-        
-        def next(self):
-            self.idx += 1
-            cell_idx = self.start + self.buf._view_x + self.idx
-            if cell_idx < self.buf.parent.width and cell_idx < len(self.row) and cell_idx < self.end:
-                val = self.row[cell_idx]
-                return val
-            else:
-                raise StopIteration()
-
-        def __getitem__(self, key):
-            if isinstance(key, slice):
-                if key.start is not None:
-                    self.start = key.start
-                if key.stop is not None:
-                    self.end = key.stop
-            return self
+        #damage the rows and columns scrolling into view
+        if dx:
+            self.mark_damaged(width - dx if dx > 0 else 0, 0, abs(dx), height)
+        if dy:
+            self.mark_damaged(0, height - dy if dy > 0 else 0, width, abs(dy))
+        self.scroll_delta = (dx, dy)
+
+    def inside_parent(self):
+        parent = self.parent
+        return (self._view_x >= 0 and self._view_y >= 0 and
+                self._view_x + self.width <= parent.width and self._view_y + self.height <= parent.height)
+
+    def draw(self, x_offset=0, y_offset=0, dirty=False, target=term):
+        delta = self.scroll_delta
+        if delta is not None and not dirty:
+            #move what's on the screen along, so only the damaged edges need drawing
+            scroll_rect = getattr(target, 'scroll_rect', None)
+            if scroll_rect is None or not scroll_rect(x_offset + self._x, y_offset + self._y,
+                                                      self.width, self.height, -delta[0], -delta[1]):
+                self.dirty = True
+        self.scroll_delta = None
+        Buffer.draw(self, x_offset, y_offset, dirty, target)
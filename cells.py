@@ -0,0 +1,496 @@
+"""
+    Compact cell storage for buffers.
+
+    Normally a buffer's data is a list of rows of [fg, bg, character] lists.
+    That's easy to work with, but it's one python list per cell - an 80x50 screen
+    is over 4,000 of them, and building or checking them means walking every cell.
+
+    CellPlanes stores the same information as three flat bytearray 'planes' instead:
+    one each for the foreground color, the background color, and the CP437 glyph.
+    The familiar row/cell protocol is still available through PlaneData, so backends
+    that iterate over _data keep working.
+
+    If numpy is installed, NumpyCellPlanes additionally exposes the planes as 2D uint8
+    arrays, so whole rectangles can be compared and copied at once.
+"""
+import collections
+import itertools
+
+import term
+
+import logging
+log = logging.getLogger('pytality.cells')
+
+try:
+    import numpy
+except ImportError, e:
+    log.debug("Could not import numpy, vectorized planes are unavailable: %r", e)
+    numpy = None
+
+__license__ = "BSD"
+__all__ = ['CellPlanes', 'NumpyCellPlanes', 'DefaultPlanes', 'PlaneData', 'PlaneRow', 'source_planes', 'utf8_glyphs']
+
+"""
+    The utf-8 for each CP437 glyph index, for backends that draw with text.
+    The codec maps 0x00-0x1F and 0x7F to control characters, which would wreak havoc
+    on a terminal, so those use the symbols the glyphs actually show.
+"""
+utf8_glyphs = [chr(i).decode('cp437').encode('utf-8') for i in range(256)]
+for i, symbol in enumerate(
+        u'\u0020\u263a\u263b\u2665\u2666\u2663\u2660\u2022\u25d8\u25cb\u25d9\u2642\u2640\u266a\u266b\u263c'
+        u'\u25ba\u25c4\u2195\u203c\u00b6\u00a7\u25ac\u21a8\u2191\u2193\u2192\u2190\u221f\u2194\u25b2\u25bc'):
+    utf8_glyphs[i] = symbol.encode('utf-8')
+utf8_glyphs[0x7F] = u'\u2302'.encode('utf-8')
+
+def glyph_index(ch):
+    """
+    Convert a cell's character (normally a 1-character string) into a glyph index.
+    """
+    if isinstance(ch, (int, long)):
+        return ch
+    return ord(ch)
+
+class CellPlanes(object):
+    """
+    A rectangular block of cells stored as fg, bg and glyph bytearrays.
+
+    Cells are stored row-major; cell (x, y) lives at offset + y*stride + x.
+    A CellPlanes can be a window onto a larger one (see window()), in which case
+    it shares the larger one's storage and stride is the width of that storage.
+    """
+    def __init__(self, width, height, fg=None, bg=None, ch=None, stride=None, offset=0):
+        """
+        width:
+        height:
+            The dimensions of the block, in cells.
+
+        fg:
+        bg:
+        ch:
+            Existing planes to use. Any that are not provided are created
+            as blank cells (black, black, ' ').
+
+        stride:
+        offset:
+            The layout of the planes, for windows onto larger storage.
+        """
+        if stride is None:
+            stride = width
+        size = stride * height
+        if fg is None:
+            fg = bytearray([term.colors.BLACK]) * size
+        if bg is None:
+            bg = bytearray([term.colors.BLACK]) * size
+        if ch is None:
+            ch = bytearray(b' ') * size
+
+        self.width = width
+        self.height = height
+        self.stride = stride
+        self.offset = offset
+        self.fg = fg
+        self.bg = bg
+        self.ch = ch
+
+    @classmethod
+    def from_rows(cls, rows, width, height):
+        """
+        Build planes from [fg, bg, character] row data, such as a Buffer's data list.
+        """
+        planes = cls(width, height)
+        fg, bg, ch = planes.fg, planes.bg, planes.ch
+        i = 0
+        for row in itertools.islice(rows, height):
+            for cell in itertools.islice(row, width):
+                fg[i] = cell[0]
+                bg[i] = cell[1]
+                ch[i] = glyph_index(cell[2])
+                i += 1
+        return planes
+
+    def to_rows(self):
+        """
+        Copy the planes out into [fg, bg, character] row data.
+        """
+        return [row[:] for row in self.data]
+
+    @property
+    def data(self):
+        """
+        A view of the planes that supports the list-of-rows buffer protocol.
+        """
+        return PlaneData(self)
+
+    def index(self, x, y):
+        return self.offset + (y * self.stride) + x
+
+    def get(self, x, y):
+        """
+        Return the cell at (x, y) as a new [fg, bg, character] list.
+        """
+        i = self.offset + (y * self.stride) + x
+        return [self.fg[i], self.bg[i], chr(self.ch[i])]
+
+    def set(self, x, y, fg=None, bg=None, ch=None):
+        """
+        Modify the cell at (x, y). Properties left as None are unchanged.
+        """
+        i = self.offset + (y * self.stride) + x
+        if fg is not None:
+            self.fg[i] = fg
+        if bg is not None:
+            self.bg[i] = bg
+        if ch is not None:
+            self.ch[i] = glyph_index(ch)
+
+    def row_span(self, y, start=0, end=None):
+        """
+        Return the (start, end) plane offsets of row y, between columns start and end.
+        """
+        if end is None:
+            end = self.width
+        base = self.offset + (y * self.stride)
+        return base + start, base + end
+
+    def clip(self, src_width, src_height, x, y):
+        """
+        Clip a src_width x src_height rectangle placed at (x, y) to these planes.
+        Returns (x0, y0, x1, y1) in our coordinates; empty if x0 >= x1 or y0 >= y1.
+        """
+        return (max(0, x), max(0, y),
+                min(self.width, x + src_width), min(self.height, y + src_height))
+
+    def blit(self, src, x, y):
+        """
+        Copy all of another CellPlanes into these ones, with its top-left corner at (x, y).
+        Cells falling outside of these planes are clipped.
+
+        Returns a list of the plane offsets (in these planes) of the cells that changed,
+        so backends can redraw just those.
+        """
+        x0, y0, x1, y1 = self.clip(src.width, src.height, x, y)
+        changed = []
+        if x0 >= x1 or y0 >= y1:
+            return changed
+
+        dfg, dbg, dch = self.fg, self.bg, self.ch
+        sfg, sbg, sch = src.fg, src.bg, src.ch
+        run = x1 - x0
+        da = self.index(x0, y0)
+        sa = src.index(x0 - x, y0 - y)
+        for row in range(y0, y1):
+            db = da + run
+            sb = sa + run
+            fg_run, bg_run, ch_run = sfg[sa:sb], sbg[sa:sb], sch[sa:sb]
+            next_da = da + self.stride
+            next_sa = sa + src.stride
+
+            #comparing whole runs is done in C, so unchanged rows are nearly free
+            if dfg[da:db] != fg_run or dbg[da:db] != bg_run or dch[da:db] != ch_run:
+                for i in range(run):
+                    d = da + i
+                    if dfg[d] != fg_run[i] or dbg[d] != bg_run[i] or dch[d] != ch_run[i]:
+                        changed.append(d)
+                dfg[da:db] = fg_run
+                dbg[da:db] = bg_run
+                dch[da:db] = ch_run
+            da = next_da
+            sa = next_sa
+        return changed
+
+    def paste(self, src, x, y):
+        """
+        As blit(), but without working out what changed.
+        """
+        x0, y0, x1, y1 = self.clip(src.width, src.height, x, y)
+        if x0 >= x1 or y0 >= y1:
+            return
+        run = x1 - x0
+        da = self.index(x0, y0)
+        sa = src.index(x0 - x, y0 - y)
+        for row in range(y0, y1):
+            self.fg[da:da + run] = src.fg[sa:sa + run]
+            self.bg[da:da + run] = src.bg[sa:sa + run]
+            self.ch[da:da + run] = src.ch[sa:sa + run]
+            da += self.stride
+            sa += src.stride
+
+    def scroll(self, x, y, width, height, dx, dy):
+        """
+        Move the cells inside a rectangle by (dx, dy), like scrolling a window.
+        Cells moved past the edge of the rectangle are lost, and the ones
+        uncovered keep their old contents until something is drawn over them.
+        """
+        x0, y0, x1, y1 = self.clip(width, height, x, y)
+        run = (x1 - x0) - abs(dx)
+        rows = (y1 - y0) - abs(dy)
+        if run <= 0 or rows <= 0:
+            return
+        src_x, dest_x = x0 + max(0, -dx), x0 + max(0, dx)
+        src_y, dest_y = y0 + max(0, -dy), y0 + max(0, dy)
+
+        sa = self.index(src_x, src_y)
+        da = self.index(dest_x, dest_y)
+        step = self.stride
+        if dy > 0:
+            #moving down, so start at the bottom to avoid copying rows we've already moved
+            sa += (rows - 1) * step
+            da += (rows - 1) * step
+            step = -step
+        fg, bg, ch = self.fg, self.bg, self.ch
+        for row in range(rows):
+            fg[da:da + run] = fg[sa:sa + run]
+            bg[da:da + run] = bg[sa:sa + run]
+            ch[da:da + run] = ch[sa:sa + run]
+            sa += step
+            da += step
+
+    def blit_rows(self, rows, width, x, y):
+        """
+        As blit(), but copying from [fg, bg, character] row data of the given width,
+        such as a list-backed Buffer's _data.
+        """
+        changed = []
+        dfg, dbg, dch = self.fg, self.bg, self.ch
+        stride = self.stride
+        max_x, max_y = self.width, self.height
+        row_y = y
+        for row in rows:
+            if row_y >= max_y:
+                break
+            if row_y >= 0:
+                cell_x = x
+                i = self.offset + (row_y * stride) + x
+                w = 0
+                for fg, bg, ch in row:
+                    if cell_x >= max_x or w >= width:
+                        break
+                    if cell_x >= 0:
+                        index = glyph_index(ch)
+                        if dfg[i] != fg or dbg[i] != bg or dch[i] != index:
+                            dfg[i] = fg
+                            dbg[i] = bg
+                            dch[i] = index
+                            changed.append(i)
+                    cell_x += 1
+                    w += 1
+                    i += 1
+            row_y += 1
+        return changed
+
+    def window(self, x, y, width, height):
+        """
+        Return planes for a rectangle inside these ones, sharing the same storage.
+        The rectangle is clipped to the planes' bounds.
+        """
+        x0 = max(0, x)
+        y0 = max(0, y)
+        x1 = min(self.width, x + width)
+        y1 = min(self.height, y + height)
+        return self.__class__(max(0, x1 - x0), max(0, y1 - y0),
+                            fg=self.fg, bg=self.bg, ch=self.ch,
+                            stride=self.stride, offset=self.index(x0, y0))
+
+def source_planes(source):
+    """
+    Return the planes to draw for a buffer (or Region) being drawn, clipped to its size,
+    or None if it's stored as lists - in which case draw its _data rows instead.
+    """
+    planes = getattr(source, '_planes', None)
+    if planes is not None and (planes.width != source.width or planes.height != source.height):
+        planes = planes.window(0, 0, source.width, source.height)
+    return planes
+
+class PlaneData(collections.MutableSequence):
+    """
+    A list-of-rows view of a CellPlanes, so code written against list buffer data
+    (backends, BufferView, tests) can read and write planes transparently.
+
+    Rows cannot be added or removed.
+    """
+    def __init__(self, planes):
+        self.planes = planes
+
+    def __len__(self):
+        return self.planes.height
+
+    def __getitem__(self, y):
+        if isinstance(y, slice):
+            return [PlaneRow(self.planes, i) for i in range(*y.indices(self.planes.height))]
+        if y < 0:
+            y += self.planes.height
+        if not 0 <= y < self.planes.height:
+            raise IndexError("row index out of range")
+        return PlaneRow(self.planes, y)
+
+    def __setitem__(self, y, row):
+        PlaneRow(self.planes, y)[:] = row
+
+    def __delitem__(self, y):
+        raise TypeError("Cell planes have a fixed size")
+
+    def insert(self, y, row):
+        raise TypeError("Cell planes have a fixed size")
+
+    def __iter__(self):
+        planes = self.planes
+        for y in range(planes.height):
+            yield PlaneRow(planes, y)
+
+    def __repr__(self):
+        return repr([row[:] for row in self])
+
+class PlaneRow(collections.MutableSequence):
+    """
+    A view of one row of a CellPlanes, acting as a list of [fg, bg, character] cells.
+    """
+    def __init__(self, planes, y):
+        self.planes = planes
+        self.y = y
+
+    def __len__(self):
+        return self.planes.width
+
+    def __getitem__(self, x):
+        planes = self.planes
+        if isinstance(x, slice):
+            start, end, step = x.indices(planes.width)
+            if step != 1:
+                return [planes.get(i, self.y) for i in range(start, end, step)]
+            a, b = planes.row_span(self.y, start, max(start, end))
+            return [list(cell) for cell in itertools.izip(planes.fg[a:b], planes.bg[a:b], str(planes.ch[a:b]))]
+        if x < 0:
+            x += planes.width
+        if not 0 <= x < planes.width:
+            raise IndexError("cell index out of range")
+        return planes.get(x, self.y)
+
+    def __setitem__(self, x, cell):
+        planes = self.planes
+        if isinstance(x, slice):
+            start, end, step = x.indices(planes.width)
+            for i, value in itertools.izip(range(start, end, step), cell):
+                planes.set(i, self.y, *value[:3])
+            return
+        if x < 0:
+            x += planes.width
+        if not 0 <= x < planes.width:
+            raise IndexError("cell index out of range")
+        planes.set(x, self.y, *cell[:3])
+
+    def __delitem__(self, x):
+        raise TypeError("Cell planes have a fixed size")
+
+    def insert(self, x, cell):
+        raise TypeError("Cell planes have a fixed size")
+
+    def __iter__(self):
+        #this is what backends hit while drawing, so hand out
+        #(fg, bg, character) tuples straight from the planes
+        planes = self.planes
+        a, b = planes.row_span(self.y)
+        return itertools.izip(planes.fg[a:b], planes.bg[a:b], str(planes.ch[a:b]))
+
+    def __repr__(self):
+        return repr(self[:])
+
+#-----------------------------------------------------------------------------
+
+def plane_arrays(planes):
+    """
+    Return (fg, bg, ch) 2D uint8 numpy arrays of shape (height, width) which share
+    memory with the bytearray planes of any CellPlanes.
+    """
+    if not planes.width or not planes.height:
+        empty = numpy.zeros((planes.height, planes.width), dtype=numpy.uint8)
+        return empty, empty, empty
+
+    row0, col0 = divmod(planes.offset, planes.stride)
+    arrays = []
+    for plane in (planes.fg, planes.bg, planes.ch):
+        full = numpy.frombuffer(plane, dtype=numpy.uint8)
+        full = full[:(len(full) // planes.stride) * planes.stride].reshape(-1, planes.stride)
+        arrays.append(full[row0:row0 + planes.height, col0:col0 + planes.width])
+    return tuple(arrays)
+
+class NumpyCellPlanes(CellPlanes):
+    """
+    CellPlanes which also expose their planes as 2D uint8 numpy arrays
+    (fg_array, bg_array, ch_array). The arrays share memory with the bytearrays,
+    so either can be used to read or write cells.
+
+    Blits into these planes are done as a vectorized != mask and slice assignment.
+    Only usable if numpy is installed.
+    """
+    #below this many cells, numpy's per-call overhead costs more than it saves
+    min_vector_cells = 64
+
+    _arrays = None
+
+    @property
+    def arrays(self):
+        #built on first use, since small buffers may never need them
+        if self._arrays is None:
+            self._arrays = plane_arrays(self)
+        return self._arrays
+
+    fg_array = property(lambda self: self.arrays[0])
+    bg_array = property(lambda self: self.arrays[1])
+    ch_array = property(lambda self: self.arrays[2])
+
+    def scroll(self, x, y, width, height, dx, dy):
+        x0, y0, x1, y1 = self.clip(width, height, x, y)
+        run = (x1 - x0) - abs(dx)
+        rows = (y1 - y0) - abs(dy)
+        if run <= 0 or rows <= 0:
+            return
+        if run * rows < self.min_vector_cells:
+            return CellPlanes.scroll(self, x, y, width, height, dx, dy)
+        src_x, dest_x = x0 + max(0, -dx), x0 + max(0, dx)
+        src_y, dest_y = y0 + max(0, -dy), y0 + max(0, dy)
+        for a in self.arrays:
+            #copy first, as the two rectangles overlap
+            a[dest_y:dest_y + rows, dest_x:dest_x + run] = a[src_y:src_y + rows, src_x:src_x + run].copy()
+
+    def blit(self, src, x, y):
+        x0, y0, x1, y1 = self.clip(src.width, src.height, x, y)
+        if x0 >= x1 or y0 >= y1:
+            return []
+        if (x1 - x0) * (y1 - y0) < self.min_vector_cells:
+            return CellPlanes.blit(self, src, x, y)
+
+        if isinstance(src, NumpyCellPlanes):
+            src_arrays = src.arrays
+        else:
+            src_arrays = plane_arrays(src)
+
+        dest = [a[y0:y1, x0:x1] for a in self.arrays]
+        source = [a[y0 - y:y1 - y, x0 - x:x1 - x] for a in src_arrays]
+        mask = (dest[0] != source[0]) | (dest[1] != source[1]) | (dest[2] != source[2])
+        rows, cols = numpy.nonzero(mask)
+        if not len(rows):
+            return []
+
+        for d, s in zip(dest, source):
+            d[...] = s
+        return (self.offset + (rows + y0) * self.stride + (cols + x0)).tolist()
+
+    def paste(self, src, x, y):
+        x0, y0, x1, y1 = self.clip(src.width, src.height, x, y)
+        if x0 >= x1 or y0 >= y1:
+            return
+        if (x1 - x0) * (y1 - y0) < self.min_vector_cells:
+            return CellPlanes.paste(self, src, x, y)
+
+        if isinstance(src, NumpyCellPlanes):
+            src_arrays = src.arrays
+        else:
+            src_arrays = plane_arrays(src)
+        for d, s in zip(self.arrays, src_arrays):
+            d[y0:y1, x0:x1] = s[y0 - y:y1 - y, x0 - x:x1 - x]
+
+#The fastest planes available, for backends' backing stores
+if numpy is not None:
+    DefaultPlanes = NumpyCellPlanes
+else:
+    DefaultPlanes = CellPlanes
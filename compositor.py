@@ -0,0 +1,113 @@
+"""
+    Compositing of buffer trees into a single frame.
+
+    Drawing a tree of buffers directly paints every node onto the screen in turn,
+    so wherever children overlap their parents, the same screen cell is written
+    several times per frame - and each of those writes goes through the backend.
+
+    A Compositor paints the tree into an in-memory frame instead, where the topmost
+    buffer at each position simply wins. It then compares the finished frame with
+    the one the backend already has, and only sends the runs of cells that changed.
+"""
+import buffer
+import cells
+import term
+
+import logging
+log = logging.getLogger('pytality.compositor')
+
+__license__ = "BSD"
+__all__ = ['Compositor']
+
+class Compositor(object):
+    """
+    Draws a tree of buffers to the terminal via a flattened frame.
+
+    Usage:
+        comp = Compositor(root, width=80, height=24)
+        comp.draw()
+        term.flip()
+
+    This replaces root.draw() - dirty tracking and damage work just as before.
+    If the screen is changed behind the compositor's back (say, by term.clear()),
+    call invalidate() so the next draw sends the whole frame.
+    """
+    def __init__(self, root, width, height):
+        """
+        root:
+            The buffer at the top of the tree to draw.
+
+        width:
+        height:
+            The dimensions of the screen.
+        """
+        self.root = root
+        self.width = width
+        self.height = height
+        self.size = (width, height)
+
+        #the frame we're composing, and a copy of what the backend has been sent.
+        #we don't know what's on the screen to begin with, so the first draw sends everything.
+        self.frame = cells.DefaultPlanes(width, height)
+        self.frame_buffer = buffer.Buffer(width, height, data=self.frame)
+        self.screen = None
+
+    def invalidate(self):
+        """
+        Forget what's on the screen, so that the next draw() sends the entire frame.
+        """
+        self.screen = None
+
+    def draw(self):
+        """
+        Compose any changes to the tree into the frame, then draw the cells
+        that differ from the last frame to the terminal.
+        """
+        self.root.draw(target=self)
+
+        if self.screen is None:
+            self.screen = cells.DefaultPlanes(self.width, self.height)
+            self.screen.paste(self.frame, 0, 0)
+            term.draw_buffer(self.frame_buffer, 0, 0)
+            return
+
+        changed = self.screen.blit(self.frame, 0, 0)
+        if len(changed) * 2 > self.width * self.height:
+            #most of the screen changed, so just send it all at once
+            term.draw_buffer(self.frame_buffer, 0, 0)
+            return
+
+        for x, y, width in self.runs(changed):
+            term.draw_buffer(buffer.Region(self.frame_buffer, x, y, width, 1), x, y)
+
+    def runs(self, changed):
+        """
+        Group a sorted list of changed frame offsets into (x, y, width) runs of
+        neighbouring cells on the same row.
+        """
+        runs = []
+        start = last = None
+        for i in changed:
+            if start is not None and i == last + 1 and i % self.width:
+                last = i
+                continue
+            if start is not None:
+                y, x = divmod(start, self.width)
+                runs.append((x, y, last - start + 1))
+            start = last = i
+        if start is not None:
+            y, x = divmod(start, self.width)
+            runs.append((x, y, last - start + 1))
+        return runs
+
+    def draw_buffer(self, source, x, y):
+        """
+        Paint a buffer into the frame. Called by Buffer.draw(target=compositor),
+        in the same way as term.draw_buffer.
+        """
+        planes = cells.source_planes(source)
+        if planes is not None:
+            self.frame.paste(planes, x, y)
+        else:
+            self.frame.blit_rows(source._data, source.width, x, y)
+        source.dirty = False
@@ -68,16 +68,21 @@ class Editor(object):
         self.setup_windows()
     
     def load_file(self, filename):
-        f = open(filename)
+        #the header's length is where the art starts in the mapped file, so count real bytes
+        f = open(filename, 'rb')
         line = f.readline()
+        f.close()
         dimensions = re.match("width: (\d+)", line)
         if dimensions:
-            width = dimensions.groups()[0]
+            width = int(dimensions.groups()[0])
+            offset = len(line)
         else:
             width = 80
-            f.seek(0)
+            offset = 0
         
-        self.data_buffer = pytality.ansi.read_to_buffer(f, width=width, max_height=self.main_window.inner_height, crop=False)
+        #rows are only decoded as the view scrolls over them, and we keep a few screens' worth
+        self.data_buffer = pytality.ansi.map_to_buffer(filename, width=width, offset=offset, crop=False,
+                                                       max_rows=self.main_window.inner_height * 4)
         self.data_view = pytality.buffer.BufferView(
             width=self.main_window.inner_width, height=self.main_window.inner_height,
             parent=self.data_buffer,
@@ -121,8 +126,6 @@ class Editor(object):
                 self.main_window.set_at(0, y, str(ym), fg=fg, bg=cbg)
             else:
                 self.main_window.set_at(0, y,  ' ', fg=fg, bg=cbg)
-                
-        self.main_window.dirty = True
 
     def move_cursor(self, x=0, y=0):
         self.cursor_x = min(self.data_buffer.width-1, max(0, self.cursor_x + x))
@@ -0,0 +1,72 @@
+"""
+    A small least-recently-used cache, for the places that keep a limited number of
+    expensive things around: rendered text, word wrapping, curses color pairs, decoded rows.
+"""
+import collections
+
+__license__ = "BSD"
+__all__ = ['LRUCache']
+
+#marks a missing entry, since None can be a cached value
+_missing = object()
+
+class LRUCache(object):
+    """
+    A mapping that remembers the order its entries were last used in.
+
+    get() and put() both count as using an entry. When put() takes the cache over
+    max_size, the least recently used entries are dropped. A max_size of None
+    never drops anything, and 0 keeps nothing (for a cache that's switched off).
+
+    Iterating goes through the keys from least to most recently used.
+    """
+    def __init__(self, max_size=None):
+        self.max_size = max_size
+        self.entries = collections.OrderedDict()
+
+    def get(self, key, default=None):
+        """
+        Return the entry for key, marking it as the most recently used, or default if there isn't one.
+        """
+        entries = self.entries
+        value = entries.pop(key, _missing)
+        if value is _missing:
+            return default
+        entries[key] = value
+        return value
+
+    def put(self, key, value):
+        """
+        Store an entry as the most recently used, dropping the least recently used
+        ones if there are now too many.
+        """
+        entries = self.entries
+        entries.pop(key, None)
+        entries[key] = value
+        if self.max_size is not None:
+            while len(entries) > self.max_size:
+                entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        return self.entries.pop(key, default)
+
+    def pop_oldest(self):
+        """
+        Remove and return the least recently used (key, value).
+        """
+        return self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __repr__(self):
+        return "<LRUCache: %d of %r>" % (len(self.entries), self.max_size)
@@ -0,0 +1,151 @@
+"""
+    A compact binary format for saving and loading trees of buffers.
+
+    Saving a screen as ANSI art loses things (cursor-right escapes come back as black
+    spaces, and colors depend on global parser state), and loading it means parsing
+    every escape again. A snapshot is just the cell planes, so loading one is a few
+    copies out of a memory-mapped file.
+
+    Each buffer in the tree is stored as:
+        a header (see header_format): magic, version, flags, size, position,
+            padding, number of children, and the size of the plane data
+        one uint32 per child: where that child starts, relative to this header
+        the fg, bg and glyph planes, width*height bytes each, in that order -
+            or all three compressed together with zlib, if flagged
+        the children, in order
+
+    Loaded buffers are plain Buffers with array (or numpy) storage: the cells, position,
+    padding and children are kept, but not what kind of buffer they were.
+"""
+import mmap
+import struct
+import zlib
+import __builtin__
+
+import buffer
+import cells
+
+import logging
+log = logging.getLogger('pytality.snapshot')
+
+__license__ = "BSD"
+__all__ = ['dumps', 'loads', 'save', 'load', 'SnapshotError']
+
+magic = 'PYTB'
+version = 1
+
+#flags
+ZLIB = 1
+
+#magic, version, flags, width, height, x, y, padding_x, padding_y, child count, plane data size
+header_format = struct.Struct('<4sBBHHhhHHHI')
+offset_format = struct.Struct('<I')
+
+#the builtin buffer, which our buffer module hides: a view of part of a string or mmap
+byte_view = __builtin__.buffer
+
+class SnapshotError(Exception):
+    pass
+
+def compact_planes(buf):
+    """
+    Return a buffer's cells as planes of exactly its size, with nothing else in the storage.
+    """
+    planes = buf._planes
+    if planes is None:
+        return cells.CellPlanes.from_rows(buf._data, buf.width, buf.height)
+    if (planes.width == buf.width and planes.height == buf.height and planes.stride == buf.width
+            and planes.offset == 0 and len(planes.fg) == buf.width * buf.height):
+        return planes
+    #a window onto something bigger
+    compact = cells.CellPlanes(buf.width, buf.height)
+    compact.paste(planes, 0, 0)
+    return compact
+
+def dumps(buf, compress=False):
+    """
+    Return a buffer and all its children as a snapshot string.
+    If compress, the planes are compressed with zlib - smaller, but they can't be
+    loaded without a copy.
+    """
+    planes = compact_planes(buf)
+    data = str(planes.fg) + str(planes.bg) + str(planes.ch)
+    flags = 0
+    if compress:
+        data = zlib.compress(data)
+        flags |= ZLIB
+
+    children = [dumps(child, compress) for child in buf.children]
+    header = header_format.pack(magic, version, flags, buf.width, buf.height, buf.x, buf.y,
+                                buf.padding_x, buf.padding_y, len(children), len(data))
+
+    #children follow the planes, one after another
+    position = header_format.size + offset_format.size * len(children) + len(data)
+    offsets = []
+    for child in children:
+        offsets.append(offset_format.pack(position))
+        position += len(child)
+    return ''.join([header] + offsets + [data] + children)
+
+def loads(data, offset=0, storage='array'):
+    """
+    Load a buffer tree from snapshot data (a string, or an mmap) starting at offset.
+
+    storage:
+        'array' or 'numpy', as for Buffer.
+    """
+    if len(data) < offset + header_format.size:
+        raise SnapshotError("Snapshot is truncated at offset %r" % offset)
+    (node_magic, node_version, flags, width, height, x, y,
+        padding_x, padding_y, child_count, size) = header_format.unpack_from(data, offset)
+    if node_magic != magic:
+        raise SnapshotError("Not a snapshot (magic %r at offset %r)" % (node_magic, offset))
+    if node_version != version:
+        raise SnapshotError("Unsupported snapshot version %r" % node_version)
+
+    start = offset + header_format.size
+    child_offsets = [offset_format.unpack_from(data, start + i * offset_format.size)[0]
+                     for i in range(child_count)]
+    start += offset_format.size * child_count
+    if len(data) < start + size:
+        raise SnapshotError("Snapshot is truncated at offset %r" % start)
+
+    cell_count = width * height
+    planes_data = data
+    if flags & ZLIB:
+        planes_data = zlib.decompress(byte_view(data, start, size))
+        start = 0
+        size = len(planes_data)
+    if size != cell_count * 3:
+        raise SnapshotError("Snapshot planes are %r bytes, expected %r" % (size, cell_count * 3))
+
+    #copied straight out of the data (or the map), without slicing it first
+    planes = buffer.planes_types[storage](width, height,
+        fg=bytearray(byte_view(planes_data, start, cell_count)),
+        bg=bytearray(byte_view(planes_data, start + cell_count, cell_count)),
+        ch=bytearray(byte_view(planes_data, start + cell_count * 2, cell_count)))
+    children = [loads(data, offset + child_offset, storage) for child_offset in child_offsets]
+    return buffer.Buffer(width, height, data=planes, x=x, y=y,
+                         padding_x=padding_x, padding_y=padding_y,
+                         children=children, storage=storage)
+
+def save(buf, filename, compress=False):
+    """
+    Save a buffer tree to a snapshot file. See dumps.
+    """
+    with open(filename, 'wb') as f:
+        f.write(dumps(buf, compress))
+
+def load(filename, storage='array'):
+    """
+    Load a buffer tree from a snapshot file, memory-mapping it rather than reading it in.
+    """
+    with open(filename, 'rb') as f:
+        if not f.read(1):
+            #an empty file can't be mapped, but it isn't a snapshot either
+            raise SnapshotError("%r is empty" % filename)
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        return loads(data, storage=storage)
+    finally:
+        data.close()
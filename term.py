@@ -48,6 +48,20 @@ def _find_impl(choices):
             except ImportError, e:
                 log.debug("Could not import term_curses: %r", e)
                 continue        
+        if choice == 'ansi':
+            try:
+                import term_ansi as _impl
+                log.debug("Imported term_ansi successfully")
+                success = True
+                break
+            except ImportError, e:
+                log.debug("Could not import term_ansi: %r", e)
+                continue
+        if choice == 'memory':
+            import term_memory as _impl
+            log.debug("Imported term_memory successfully")
+            success = True
+            break
         
     if not success:
         raise NoConsoleAvailableError("Could not find any suitable console library. You may need a working curses implementation if you are on linux.")
@@ -56,6 +70,9 @@ def _find_impl(choices):
 #Our global terminal implementation
 impl = None
 
+#The current screen dimensions as (width, height), as set by resize()
+size = None
+
 class colors:
     """
     Constants for the sixteen ANSI colors.
@@ -90,7 +107,9 @@ def init(**kwargs):
         Supports the following keys:
         backends:
             A list of backends to try, in order.
-            Defaults to ['silverlight', 'winconsole', 'pygame', 'curses']
+            Defaults to ['silverlight', 'winconsole', 'pygame', 'ansi', 'curses']
+            'memory' is also available: a headless backend that displays nothing,
+            for running tests and benchmarks without a screen.
 
         width:
         height:
@@ -103,7 +122,7 @@ def init(**kwargs):
     log.debug("init(): initializing terminal")
 
     default_config = dict(
-        backends = ['silverlight', 'winconsole', 'pygame', 'curses'],
+        backends = ['silverlight', 'winconsole', 'pygame', 'ansi', 'curses'],
         width = 80,
         height = 24,
     )
@@ -141,8 +160,10 @@ def resize(width, height):
     On Linux/Mac, this can only verify the terminal's size is sufficient
     and raises TerminalTooSmallError if it isn't.
     """
+    global size
     log.debug("resize(): target width=%r, height=%r", width, height)
     impl.resize(width, height)
+    size = (width, height)
 
 #-----------------------------------------------------------------------------
 # Drawing functions
@@ -164,6 +185,19 @@ def draw_buffer(buf, x, y):
     """
     impl.draw_buffer(buf, x, y)
 
+def scroll_rect(x, y, width, height, dx, dy):
+    """
+    Move what has already been drawn inside a rectangle of the screen by (dx, dy) cells,
+    so a scrolled buffer only needs to draw the edge that was uncovered.
+
+    Returns False if the backend can't do this (or not for that rectangle),
+    in which case the whole rectangle has to be drawn again.
+    """
+    scroll = getattr(impl, 'scroll_rect', None)
+    if scroll is None:
+        return False
+    return scroll(x, y, width, height, dx, dy)
+
 def flip():
     """
     Refresh the terminal, flushing all changes to the screen.
@@ -0,0 +1,255 @@
+"""
+    A pure ANSI/VT100 backend, for any terminal that understands escape codes - including over SSH.
+
+    Buffers are drawn into a back grid of cells. flip() compares it with a front grid
+    holding what the terminal is already showing, and writes only the cells that changed:
+    the cursor is only moved where a run of changes breaks, and colors are only set
+    when they change. The whole frame goes out in a single write.
+
+    When a wide enough rectangle is scrolled up or down, the terminal is asked to
+    scroll those lines itself (with a scroll region), so only the uncovered lines
+    need to be written.
+"""
+import os
+import sys
+import select
+import termios
+import tty
+import fcntl
+import struct
+
+import ansi
+import cells
+
+import logging
+log = logging.getLogger('pytality.term.ansi')
+
+__license__ = "BSD"
+
+"""
+    The SGR sequence for each color pair, indexed by fg | (bg << 4).
+    ANSI numbers its eight colors in a different order than we do (red and blue are swapped, etc),
+    and the bright versions are 90-97 (foreground) and 100-107 (background).
+"""
+ansi_order = [0, 4, 2, 6, 1, 5, 3, 7]
+def _sgr(fg, bg):
+    fg_code = (90 if fg & 8 else 30) + ansi_order[fg & 7]
+    bg_code = (100 if bg & 8 else 40) + ansi_order[bg & 7]
+    return '\x1b[%d;%dm' % (fg_code, bg_code)
+sgr = [_sgr(key & 0xF, key >> 4) for key in range(256)]
+
+#the utf-8 to draw for each glyph index
+glyphs = cells.utf8_glyphs
+
+#file descriptors we talk to the terminal over
+in_fd = None
+out_fd = None
+#the terminal settings to restore on reset()
+saved_attrs = None
+
+#what the terminal is showing, and what we've drawn for the next flip
+front = None
+back = None
+max_x = max_y = 0
+
+#the color pair the terminal currently has selected, or None if we don't know
+current_color = None
+
+#line scrolls to send at the next flip, as (top, bottom, dy)
+pending_scrolls = []
+
+cursor_x = 0
+cursor_y = 0
+cursor_type = 0
+
+def write(data):
+    #os.write can stop early on a busy tty, so keep going until it's all out
+    while data:
+        written = os.write(out_fd, data)
+        data = data[written:]
+
+def init():
+    global in_fd, out_fd, saved_attrs, cursor_type, current_color
+    in_fd = sys.stdin.fileno()
+    out_fd = sys.stdout.fileno()
+    sys.stdout.flush()
+
+    #raw mode: keys arrive as they're pressed, unechoed, and ^C is just another key
+    saved_attrs = termios.tcgetattr(in_fd)
+    tty.setraw(in_fd)
+
+    #switch to the alternate screen and hide the cursor
+    write('\x1b[?1049h\x1b[?25l')
+    cursor_type = 0
+    current_color = None
+
+def reset():
+    write('\x1b[0m\x1b[?25h\x1b[?1049l')
+    if saved_attrs is not None:
+        termios.tcsetattr(in_fd, termios.TCSADRAIN, saved_attrs)
+
+#----------------------------------------------------------------------------
+#Screen functions
+
+def get_size():
+    """
+        Ask the terminal how big it is, as (width, height).
+    """
+    rows, columns, _, _ = struct.unpack('HHHH', fcntl.ioctl(out_fd, termios.TIOCGWINSZ, '\0' * 8))
+    return columns, rows
+
+def resize(width, height):
+    """
+        Like curses, we can't resize the terminal - just check it's big enough.
+    """
+    global max_x, max_y
+    x, y = get_size()
+    if y < height or x < width:
+        raise Exception("Your window is x=%s, y=%s. Minimum required size is x=%s, y=%s" % (x, y, width, height))
+    max_x, max_y = width, height
+    clear()
+
+def clear():
+    global front, back, current_color
+    #erasing fills with the current background, so select ours first
+    current_color = 7
+    write(sgr[current_color] + '\x1b[2J')
+    front = cells.DefaultPlanes(max_x, max_y)
+    back = cells.DefaultPlanes(max_x, max_y)
+    del pending_scrolls[:]
+
+def scroll_lines():
+    """
+        Send the pending line scrolls to the terminal, scrolling the front grid to match.
+        Returns the output that does it.
+    """
+    out = []
+    for top, bottom, dy in pending_scrolls:
+        #scroll regions are whole lines, so the cells either side of the rectangle
+        #move too - but front knows that, so they'll just be written again
+        front.scroll(0, top, max_x, bottom - top, 0, dy)
+        if dy < 0:
+            out.append('\x1b[%d;%dr\x1b[%dS' % (top + 1, bottom, -dy))
+            uncovered = front.row_span(bottom + dy)[0], front.row_span(bottom - 1)[1]
+        else:
+            out.append('\x1b[%d;%dr\x1b[%dT' % (top + 1, bottom, dy))
+            uncovered = front.row_span(top)[0], front.row_span(top + dy - 1)[1]
+        #we don't know what the terminal filled the new lines with, so make sure they get written
+        start, end = uncovered
+        front.fg[start:end] = bytearray([0xFF]) * (end - start)
+    del pending_scrolls[:]
+    if out:
+        #put the scroll region back to the whole screen
+        out.append('\x1b[r')
+    return ''.join(out)
+
+def render():
+    """
+        Bring the front grid up to date with the back grid,
+        returning the output that does the same to the terminal.
+    """
+    global current_color
+    scrolled = scroll_lines()
+    changed = front.blit(back, 0, 0)
+    if not changed:
+        return scrolled
+
+    local_sgr, local_glyphs = sgr, glyphs
+    fg, bg, ch = front.fg, front.bg, front.ch
+    width = max_x
+    color = current_color
+
+    out = []
+    add = out.append
+    #the offset the terminal cursor is sitting at
+    pos = None
+    for i in changed:
+        if i != pos or not i % width:
+            #not where the last run left off (or we'd have to wrap a line), so move there
+            y, x = divmod(i, width)
+            add('\x1b[%d;%dH' % (y + 1, x + 1))
+        key = fg[i] | (bg[i] << 4)
+        if key != color:
+            add(local_sgr[key])
+            color = key
+        add(local_glyphs[ch[i]])
+        pos = i + 1
+
+    current_color = color
+    return scrolled + ''.join(out)
+
+def flip():
+    data = render()
+    if cursor_type:
+        #put the cursor back where it's meant to be
+        data += '\x1b[%d;%dH' % (cursor_y + 1, cursor_x + 1)
+    if data:
+        write(data)
+
+def draw_buffer(source, start_x, start_y):
+    planes = cells.source_planes(source)
+    if planes is not None:
+        back.paste(planes, start_x, start_y)
+    else:
+        back.blit_rows(source._data, source.width, start_x, start_y)
+    source.dirty = False
+
+def scroll_rect(x, y, width, height, dx, dy):
+    if x < 0 or y < 0 or x + width > max_x or y + height > max_y:
+        return False
+    back.scroll(x, y, width, height, dx, dy)
+    #for anything but wide vertical scrolls, letting render() write the changes is cheaper
+    if dy and not dx and width * 2 > max_x:
+        pending_scrolls.append((y, y + height, dy))
+    return True
+
+def get_at(x, y):
+    if x < 0 or x >= max_x or y < 0 or y >= max_y:
+        raise ValueError("get_at: Invalid coordinate (%r, %r)" % (x,y))
+    return back.get(x, y)
+
+def move_cursor(x, y):
+    global cursor_x, cursor_y
+    cursor_x = x
+    cursor_y = y
+    if cursor_type:
+        write('\x1b[%d;%dH' % (y + 1, x + 1))
+
+def set_title(title):
+    write("\x1b]2;%s\x07" % title)
+
+def set_cursor_type(i):
+    global cursor_type
+    cursor_type = i
+    if not i:
+        write('\x1b[?25l')
+    else:
+        #DECSCUSR: 4 is a steady underline, 2 a steady block
+        write('\x1b[%d q\x1b[?25h' % (4 if i == 1 else 2))
+
+#--------------------------------------
+#Input functions
+
+class KeyReader:
+    """
+        Feeds the rest of an escape sequence to ansi.parse_escape.
+    """
+    def read(self, n):
+        return os.read(in_fd, n)
+
+def raw_getkey():
+    key = os.read(in_fd, 1)
+    log.debug("key is %r", key)
+    if key in ('\r', '\n'):
+        return 'enter'
+    elif key == '\x1b':
+        #a lone ESC, or the start of an escape sequence?
+        #the sequence's bytes arrive together, so if nothing follows right away it was the key.
+        if not select.select([in_fd], [], [], 0.05)[0]:
+            return 'esc'
+        esc = ansi.parse_escape(KeyReader(), is_key=True)
+        if esc.is_key:
+            return esc.meaning
+        log.debug("got back a non-key on getkey! meaning=%r", esc.meaning)
+        return None
+    return key
@@ -4,6 +4,8 @@ import locale
 
 import logging
 import ansi
+import cells
+import lru
 log = logging.getLogger('pytality.term.curses')
     
 #Curses requires this fairly magical invocation to support unicode correctly
@@ -39,6 +41,7 @@ def init():
     curses.start_color()
     scr.keypad(False)
     curses.noecho()
+    init_colors()
 
 class Glyph(str):
     """
@@ -46,13 +49,35 @@ class Glyph(str):
     """
     pass
 
+#every glyph, converted once up front
+glyphs = [Glyph(g) for g in cells.utf8_glyphs]
+
+#the glyph for each way a cell can spell its character:
+#a codepage 437 character, a glyph index, or an already-converted Glyph
+glyph_map = {}
+for i, glyph in enumerate(glyphs):
+    glyph_map[chr(i)] = glyph
+    glyph_map[i] = glyph
+for glyph in glyphs:
+    glyph_map[glyph] = glyph
+
+#likewise, the glyph index for each of them, for the shadow grid
+glyph_indexes = {}
+for i, glyph in enumerate(glyphs):
+    glyph_indexes[glyph] = i
+for i in range(256):
+    #(printable ascii Glyphs are the same strings as the characters, which win)
+    glyph_indexes[chr(i)] = i
+    glyph_indexes[i] = i
+
 def uni(c):
     """
         Convert a string from codepage 437 to unicode.
-        We use Glyph shenanigans to not convert twice.
+        Single characters come straight out of the glyph table.
     """
-    if isinstance(c, Glyph):
-        return c
+    glyph = glyph_map.get(c)
+    if glyph is not None:
+        return glyph
     return Glyph(c.decode('cp437').encode('utf-8'))
 
 #----------------------------------------------------------------------------
@@ -67,6 +92,10 @@ def clear():
     scr.erase()
     scr.refresh()
 
+    #a copy of what's on the screen, so we only draw what changes
+    global shadow
+    shadow = cells.DefaultPlanes(MAX_X, MAX_Y)
+
 def resize(width, height):
     """
         It's a little weird, but curses effectively demands an extra row and column
@@ -84,7 +113,9 @@ def resize(width, height):
         raise Exception("Your window is x=%s, y=%s. Minimum required size is x=%s, y=%s" % (x, y, width, height))
         curses.resizeterm(height, width)
         scr.resize(height, width)
-        
+
+    #start from a blank screen, so the shadow grid matches it
+    clear()
     
 def reset():
     curses.nocbreak()
@@ -100,60 +131,211 @@ def set_title(title):
 def set_cursor_type(i):
     curses.curs_set(i)
 
-color_pairs = {}
-next_pair = 0
+"""
+    Curses wants its colors to be in preset "color pairs",
+    so each of our fg/bg combinations has to be translated into one.
+
+    Bright foregrounds are the same pair plus A_BOLD, so there are only 8x8 pairs to go around.
+    Normally they're all set up front by init_colors(), and color_attrs holds the finished
+    attribute for every combination. Terminals with fewer pairs than that share them out
+    on demand instead, recycling the least recently used pair when they run out.
+"""
+#the curses attribute for each fg/bg combination, indexed by fg | (bg << 4)
+#(attributes can be 0, so None marks the combinations that lru_color hands out)
+color_attrs = [None] * 256
+
+#on terminals short of pairs: {(curses fg, curses bg): pair number}, least recently used first
+pair_lru = None
+
+def init_colors():
+    global pair_lru
+    color_attrs[:] = [None] * 256
+    pair_lru = None
+
+    if not curses.has_colors():
+        #no color at all, but we can still do bright
+        for key in range(256):
+            color_attrs[key] = curses.A_BOLD if color_map[key & 0xF][1] else 0
+        return
+
+    if curses.COLOR_PAIRS < 64:
+        log.debug("only %r color pairs available, sharing them out as needed", curses.COLOR_PAIRS)
+        pair_lru = lru.LRUCache()
+        return
+
+    for fg_color in range(8):
+        for bg_color in range(8):
+            pair = pair_number(fg_color, bg_color)
+            if pair:
+                curses.init_pair(pair, fg_color, bg_color)
+
+    for key in range(256):
+        fg_color, bold = color_map[key & 0xF]
+        bg_color, _ = color_map[key >> 4] #backgrounds can't be bold
+        attr = curses.color_pair(pair_number(fg_color, bg_color))
+        if bold:
+            attr |= curses.A_BOLD
+        color_attrs[key] = attr
+
+def pair_number(fg_color, bg_color):
+    """
+        The pair each curses color combination gets when there are enough to go around.
+        Pair 0 can't be changed, but it's already white on black, so that combination uses it.
+    """
+    pair = fg_color + (bg_color * 8)
+    if pair == curses.COLOR_WHITE:
+        return 0
+    if pair == 0:
+        return curses.COLOR_WHITE
+    return pair
+
 def get_color(fg, bg):
-    '''
-        Curses wants it's colors to be in preset "color pairs",
-        so we have to translate each combination into one.
-    '''
-    global next_pair
-    #convert the color IDs to curses colors
-    fg, bold = color_map[fg]
-    bg, _ = color_map[bg] #backgrounds can't be bold
-
-    if (fg, bg) not in color_pairs:
-        next_pair += 1
-        #log.debug("creating pair %i: (%r, %r)", next_pair, fg, bg)
-
-        curses.init_pair(next_pair, fg, bg)
-        color_pair = curses.color_pair(next_pair)
-        color_pairs[(fg, bg)] = color_pair
+    """
+        Get the curses attribute for a color combination.
+    """
+    attr = color_attrs[fg | (bg << 4)]
+    if attr is None:
+        attr = lru_color(fg, bg)
+    return attr
 
-    else:
-        color_pair = color_pairs[(fg, bg)]
+def lru_color(fg, bg):
+    """
+        Find or make a color pair on a terminal that doesn't have enough for them all.
+    """
+    fg_color, bold = color_map[fg]
+    bg_color, _ = color_map[bg]
+
+    pair_key = (fg_color, bg_color)
+    pair = pair_lru.get(pair_key)
+    if pair is None:
+        #(pair 0 can't be changed, so we start at 1)
+        if len(pair_lru) < curses.COLOR_PAIRS - 1:
+            pair = len(pair_lru) + 1
+        else:
+            #recycle the pair that's gone unused the longest.
+            #anything still on screen in its old colors changes color too - sorry!
+            _, pair = pair_lru.pop_oldest()
+        #log.debug("creating pair %i: (%r, %r)", pair, fg_color, bg_color)
+        curses.init_pair(pair, fg_color, bg_color)
+        pair_lru.put(pair_key, pair)
+
+    attr = curses.color_pair(pair)
     if bold:
-        color_pair |= curses.A_BOLD
-        
-    return color_pair
+        attr |= curses.A_BOLD
+    return attr
     
 def draw_buffer(source, start_x, start_y):
-    global MAX_X, MAX_Y
+    """
+        Draw the cells of the buffer that differ from the shadow grid,
+        with one addstr for each run of neighbouring cells that share their colors.
+        Crossing into curses is the expensive part, so this keeps it to a minimum.
+    """
+    planes = cells.source_planes(source)
+    if planes is not None:
+        changed = shadow.blit(planes, start_x, start_y)
+        if changed:
+            draw_runs(changed)
+        source.dirty = False
+        return
+
+    local_fg, local_bg, local_ch = shadow.fg, shadow.bg, shadow.ch
+    local_glyphs, local_indexes, local_attrs = glyphs, glyph_indexes, color_attrs
+    addstr = scr.addstr
+    source_width = source.width
+    screen_width, screen_height = MAX_X, MAX_Y
+
     y = start_y
     for row in source._data:
         if y < 0:
             y += 1
             continue
+        if y >= screen_height:
+            break
         x = start_x
-        for fg, bg, ch in row[:source.width]:
-            if x < 0:
-                x += 1
-                continue
-            color = get_color(fg, bg)
-            ch = uni(ch)
-            #log.debug("x: %r y: %r ch: %r, w: %r h: %r", x, y, ch, buf.width, buf.height)
-            scr.addstr(y, x, ch, color)
-            x += 1
-            if x >= MAX_X:
-                #log.debug("Breaking line early (%r >= %r)", x, MAX_X)
+        i = (y * screen_width) + x
+
+        #the run of changed cells we're building up, from run_x to just before run_end
+        run = key = None
+        run_end = 0
+
+        w = 0
+        for fg, bg, ch in row:
+            if x >= screen_width or w >= source_width:
                 break
+            if x >= 0:
+                index = local_indexes.get(ch)
+                if index is None:
+                    #not in the glyph table (several characters, say): draw it as uni() makes it,
+                    #on its own, and leave its shadow cell and the next one matching nothing -
+                    #so the next cell gets drawn over any overflow, and whatever goes here next is drawn
+                    glyph = uni(ch)
+                    local_fg[i] = 0xFF
+                    if x + 1 < screen_width:
+                        local_fg[i + 1] = 0xFF
+                elif local_fg[i] != fg or local_bg[i] != bg or local_ch[i] != index:
+                    glyph = local_glyphs[index]
+                    local_fg[i] = fg
+                    local_bg[i] = bg
+                    local_ch[i] = index
+                else:
+                    glyph = None
+                if glyph is not None:
+                    cell_key = fg | (bg << 4)
+                    if cell_key == key and x == run_end:
+                        run += glyph
+                    else:
+                        if run:
+                            attr = local_attrs[key]
+                            if attr is None:
+                                attr = lru_color(key & 0xF, key >> 4)
+                            addstr(y, run_x, run, attr)
+                        run = glyph
+                        run_x = x
+                        key = cell_key
+                    run_end = x + 1 if index is not None else None
+            x += 1
+            w += 1
+            i += 1
+        if run:
+            attr = local_attrs[key]
+            if attr is None:
+                attr = lru_color(key & 0xF, key >> 4)
+            addstr(y, run_x, run, attr)
         y += 1
-        if y >= MAX_Y:
-            #log.debug("Breaking draw early (%r >= %r)", y, MAX_Y)
-            break
-            
+
     source.dirty = False
-    return
+
+def draw_runs(changed):
+    """
+        Draw a sorted list of changed shadow offsets, in runs as per draw_buffer.
+    """
+    local_fg, local_bg, local_ch = shadow.fg, shadow.bg, shadow.ch
+    local_glyphs, local_attrs = glyphs, color_attrs
+    width = MAX_X
+
+    run = []
+    start = key = None
+    last = -2
+    for i in changed:
+        cell_key = local_fg[i] | (local_bg[i] << 4)
+        if i != last + 1 or cell_key != key or not i % width:
+            if run:
+                y, x = divmod(start, width)
+                attr = local_attrs[key]
+                if attr is None:
+                    attr = lru_color(key & 0xF, key >> 4)
+                scr.addstr(y, x, ''.join(run), attr)
+            run = []
+            start = i
+            key = cell_key
+        run.append(local_glyphs[local_ch[i]])
+        last = i
+
+    y, x = divmod(start, width)
+    attr = local_attrs[key]
+    if attr is None:
+        attr = lru_color(key & 0xF, key >> 4)
+    scr.addstr(y, x, ''.join(run), attr)
 
 def get_at(x, y):
     """
@@ -182,7 +364,7 @@ def get_at(x, y):
         ch = chars
 
     #log.debug('ch: %r', ch)
-    return [None, None, ch]
+    return [None, None, glyph_map.get(ch, ch)]
 
 def move_cursor(x, y):
     scr.move(y, x)
@@ -0,0 +1,116 @@
+"""
+    A headless backend that draws into memory instead of onto a screen.
+
+    Nothing is displayed, and keyboard input comes from a scripted queue,
+    so this runs anywhere - CI servers, benchmarks, or over a plain pipe.
+    Because it does no real output, timing it measures Pytality's own overhead.
+
+    Usage:
+        term.init(backends=['memory'])
+        term.impl.push_keys('a', 'enter')
+"""
+import collections
+
+import cells
+
+import logging
+log = logging.getLogger('pytality.term.memory')
+
+__license__ = "BSD"
+
+class NoMoreInputError(Exception):
+    """
+    Raised by raw_getkey() when the scripted input has run out,
+    rather than waiting forever for a key that will never come.
+    """
+    pass
+
+#scripted keyboard input, consumed from the left by raw_getkey()
+keys = collections.deque()
+
+#how many times flip() has been called since init()
+frames = 0
+
+#what's "on the screen"
+cell_data = None
+max_x = max_y = 0
+
+#cursor and window state, kept so tests can inspect it
+cursor_x = 0
+cursor_y = 0
+cursor_type = 0
+title = None
+
+def init():
+    global frames, cursor_x, cursor_y, cursor_type, title
+    frames = 0
+    cursor_x = cursor_y = 0
+    cursor_type = 0
+    title = None
+    keys.clear()
+
+def reset():
+    keys.clear()
+
+def push_keys(*new_keys):
+    """
+    Queue up keys for raw_getkey() to return, in order.
+    Use the same names the other backends do: 'a', 'enter', 'up', '\\x03', and so on.
+    """
+    keys.extend(new_keys)
+
+#----------------------------------------------------------------------------
+#Screen functions
+
+def flip():
+    global frames
+    frames += 1
+
+def clear():
+    global cell_data
+    cell_data = cells.DefaultPlanes(max_x, max_y)
+
+def resize(width, height):
+    global max_x, max_y
+    max_x, max_y = width, height
+    clear()
+
+def set_title(new_title):
+    global title
+    title = new_title
+
+def set_cursor_type(i):
+    global cursor_type
+    cursor_type = i
+
+def move_cursor(x, y):
+    global cursor_x, cursor_y
+    cursor_x = x
+    cursor_y = y
+
+def draw_buffer(source, start_x, start_y):
+    planes = cells.source_planes(source)
+    if planes is not None:
+        cell_data.paste(planes, start_x, start_y)
+    else:
+        cell_data.blit_rows(source._data, source.width, start_x, start_y)
+    source.dirty = False
+
+def scroll_rect(x, y, width, height, dx, dy):
+    if x < 0 or y < 0 or x + width > max_x or y + height > max_y:
+        return False
+    cell_data.scroll(x, y, width, height, dx, dy)
+    return True
+
+def get_at(x, y):
+    if x < 0 or x >= max_x or y < 0 or y >= max_y:
+        raise ValueError("get_at: Invalid coordinate (%r, %r)" % (x,y))
+    return cell_data.get(x, y)
+
+#----------------------------------------------------------------------------
+#Keyboard functions
+
+def raw_getkey():
+    if not keys:
+        raise NoMoreInputError("raw_getkey: no scripted input left")
+    return keys.popleft()
@@ -3,6 +3,8 @@ import pygame
 import threading, time
 from pygame.locals import *
 
+import cells
+
 import logging
 log = logging.getLogger('pytality.term.pygame')
 
@@ -50,6 +52,25 @@ H = 12
 #loaded sprite data
 sprites = {}
 
+#glyph atlas pages: one surface per (fg, bg) color pair, holding all 256 glyphs
+#in the same 16x16 grid as the char/*.png images. indexed by fg | (bg << 4),
+#and baked the first time that pair of colors is drawn.
+pages = [None] * 256
+
+#the area of a page that each glyph index occupies
+glyph_areas = [pygame.Rect((i % 16) * W, (i // 16) * H, W, H) for i in range(256)]
+
+#Surface.blits() (pygame 1.9.4+) submits a whole sequence of blits in one call
+has_blits = hasattr(pygame.Surface, 'blits')
+
+#the cells drawn since the last flip, as {row: [start_x, end_x]} spans.
+#None means the whole display needs updating, which is also how we start.
+damage = None
+
+#once more than this fraction of the display has changed, one full flip
+#is cheaper than handing pygame a long list of small rects
+full_flip_fraction = 0.3
+
 #have we quit?
 quit = False
 
@@ -138,7 +159,7 @@ def replace_character():
     replaced_character = (cursor_x, cursor_y, fg, bg, ch)
 
     blit_at(cursor_x, cursor_y, 7, bg, cursor_type)
-    pygame.display.flip()
+    update_cell(cursor_x, cursor_y)
 
 def restore_character():
     global replaced_character
@@ -146,9 +167,42 @@ def restore_character():
         return
     x, y, fg, bg, ch = replaced_character
     blit_at(x, y, fg, bg, ch)
-    pygame.display.flip()
+    update_cell(x, y)
     replaced_character = None
 
+def update_cell(x, y):
+    #push a single cell to the display, without waiting for the next flip
+    pygame.display.update(pygame.Rect(x * W, y * H, W, H))
+
+def mark_damaged(y, start_x, end_x):
+    #remember that cells start_x..end_x-1 of row y need to reach the display at the next flip
+    if damage is None:
+        return
+    span = damage.get(y)
+    if span is None:
+        damage[y] = [start_x, end_x]
+    else:
+        if start_x < span[0]:
+            span[0] = start_x
+        if end_x > span[1]:
+            span[1] = end_x
+
+def damage_rects():
+    """
+        Turn the damaged row spans into pixel rects,
+        merging runs of rows that have identical spans.
+    """
+    rects = []
+    last_y = last_span = None
+    for y in sorted(damage):
+        span = damage[y]
+        if last_span == span and last_y == y - 1:
+            rects[-1].h += H
+        else:
+            rects.append(pygame.Rect(span[0] * W, y * H, (span[1] - span[0]) * W, H))
+        last_y, last_span = y, span
+    return rects
+
 #----------------------------------------------------------------------------
 #Actual functions
 
@@ -172,8 +226,18 @@ def flip():
             #we don't actually care
             pass
 
-    #flip the screen
-    pygame.display.flip()
+    #update the parts of the screen that changed, or flip the whole thing
+    global damage
+    if damage is None:
+        pygame.display.flip()
+    elif damage:
+        rects = damage_rects()
+        area = sum(rect.w * rect.h for rect in rects)
+        if area > full_flip_fraction * screen.get_width() * screen.get_height():
+            pygame.display.flip()
+        else:
+            pygame.display.update(rects)
+    damage = {}
 
 def clear():
     if quit:
@@ -181,14 +245,13 @@ def clear():
     
     screen.fill((0, 0, 0))
 
+    global damage
+    damage = None
+
+    #what's currently on the screen, as cell planes.
+    #with numpy available, blitting planes-backed buffers into this is vectorized.
     global cell_data
-    cell_data = [
-        [
-            [0, 0, ' ']
-            for cell in range(max_x)
-        ]
-        for row in range(max_y)
-    ]
+    cell_data = cells.DefaultPlanes(max_x, max_y)
 
 def resize(width, height):
     global screen
@@ -203,6 +266,10 @@ def resize(width, height):
     global max_x, max_y
     max_x, max_y = width, height
 
+    #the pixel position of each cell on the screen, by cell_data offset
+    global cell_dests
+    cell_dests = [(x * W, y * H) for y in range(height) for x in range(width)]
+
     clear()
     flip()
         
@@ -234,68 +301,70 @@ def set_cursor_type(i):
     cursor_type = cursor_map[i]
 
 
-def cache_sprite(fg, bg, ch):
-    bg_sprite = sprites['bg']
+def bake_page(fg, bg):
+    """
+        Render all 256 glyphs in one fg/bg color pair into an atlas page.
+        That's one fill and one blit, instead of two blits per distinct cell.
+    """
     fg_sprite = sprites[fg]
-    index = ord(ch)
-
-    #coordinates on the bg sprite map
-    bg_x = bg * W
-
-    #coordinates on the fg sprite map
-    fg_x = (index % 16) * W
-    fg_y = int(index / 16) * H
-
-    cell_sprite = pygame.Surface((W, H))
+    page = pygame.Surface(fg_sprite.get_size())
     #voodoo: this helps a little bit.
-    cell_sprite.set_alpha(None)
+    page.set_alpha(None)
 
-    #blit the background and foreground to the cell
-    cell_sprite.blit(bg_sprite, dest=(0, 0), area=pygame.Rect(bg_x, 0, W, H))
-    cell_sprite.blit(fg_sprite, dest=(0, 0), area=pygame.Rect(fg_x, fg_y, W, H))
-    sprites[(fg, bg, ch)] = cell_sprite
-    return cell_sprite
+    #colors.png is a strip of solid W-wide color swatches
+    page.fill(sprites['bg'].get_at((bg * W, 0)))
+    page.blit(fg_sprite, dest=(0, 0))
+    pages[fg | (bg << 4)] = page
+    return page
 
 def blit_at(x, y, fg, bg, ch):
     #blit one character to the screen.
     #because function calls are pricey, this is also inlined (ew) in draw_buffer, so the contents are kept short.
+    page = pages[fg | (bg << 4)]
+    if page is None:
+        page = bake_page(fg, bg)
 
-    #coordinates on the screen
-    screen_x = x * W
-    screen_y = y * H
-
-    #cache each (bg, fg, index) cell we draw into a surface so it's easier to redraw.
-    #it's a little bit of a memory waste, and takes longer on the first draw, but we're dealing with ascii here
-    #so there's probably a lot of reuse.
-    try:
-        cell_sprite = sprites[(fg, bg, ch)]
-    except KeyError:
-        #make a new one
-        cell_sprite = cache_sprite(fg, bg, ch)
-    
-    #blit the cell to the screen
-    screen.blit(cell_sprite, dest=(screen_x, screen_y))
-    
-    
-        
+    #blit the glyph's area of the page to the screen
+    screen.blit(page, (x * W, y * H), glyph_areas[ord(ch)])
+
+def flush_blits(blits):
+    """
+        Blit a list of (page, dest, area) tuples to the screen, in order.
+    """
+    if not blits:
+        return
+    if has_blits:
+        screen.blits(blits, 0)
+    else:
+        local_blit = screen.blit
+        for page, dest, area in blits:
+            local_blit(page, dest, area)
 
-   
 def draw_buffer(source, start_x, start_y):
     """
         render the buffer to our backing.
 
         This is a hotpath, and there's more microoptimization here than i'd like, but FPS is kindof important.
     """
+    planes = cells.source_planes(source)
+    if planes is not None:
+        draw_planes(source, planes, start_x, start_y)
+        source.dirty = False
+        return
 
     y = start_y
     
     #lookups we can cache into locals
     #i know, it's such a microoptimization, but this path qualifies as hot
-    local_cell_data, local_sprites, local_screen = cell_data, sprites, screen
-    local_W, local_H = W, H
+    local_pages, local_areas, local_dests = pages, glyph_areas, cell_dests
+    local_fg, local_bg, local_ch = cell_data.fg, cell_data.bg, cell_data.ch
     screen_width, screen_height = max_x, max_y
     source_width = source.width
 
+    #the blits are collected up and submitted in one go at the end
+    blits = []
+    add_blit = blits.append
+
     for row in source._data:
         if y < 0:
             y += 1
@@ -303,6 +372,8 @@ def draw_buffer(source, start_x, start_y):
         if y >= screen_height:
             break
         x = start_x
+        i = (y * screen_width) + x
+        first_x = None
 
         #do something analogous to row[:source.width]
         #but without the pointless copy that requires
@@ -313,36 +384,95 @@ def draw_buffer(source, start_x, start_y):
 
             if x >= 0:
                 #no need to blit if it's already identical
-                old_data = local_cell_data[y][x]
-                new_data = [fg, bg, ch]
-
-                if new_data != old_data:
+                index = ord(ch)
+                if local_fg[i] != fg or local_bg[i] != bg or local_ch[i] != index:
                     #draw it and remember the info for our cache
                     #this used to call blit_at but now it's inline.
-                    try:
-                        cell_sprite = sprites[(fg, bg, ch)]
-                    except KeyError:
-                        #make a new one
-                        cell_sprite = cache_sprite(fg, bg, ch)
+                    page = local_pages[fg | (bg << 4)]
+                    if page is None:
+                        page = bake_page(fg, bg)
                     
-                    #blit the cell to the screen
-                    local_screen.blit(cell_sprite, dest=(x*local_W, y*local_H))
+                    #queue the cell's blit to the screen
+                    add_blit((page, local_dests[i], local_areas[index]))
+                    if first_x is None:
+                        first_x = x
+                    last_x = x
 
                     #remember the info for the cache
-                    local_cell_data[y][x] = new_data
+                    local_fg[i] = fg
+                    local_bg[i] = bg
+                    local_ch[i] = index
                 
             x += 1
             w += 1
+            i += 1
+        if first_x is not None:
+            mark_damaged(y, first_x, last_x + 1)
         y += 1
 
+    flush_blits(blits)
     source.dirty = False
     return
 
+def scroll_rect(x, y, width, height, dx, dy):
+    """
+        Shift a rectangle of the screen's pixels with Surface.scroll,
+        instead of blitting every glyph in it again.
+    """
+    if x < 0 or y < 0 or x + width > max_x or y + height > max_y:
+        return False
+    #don't drag the cursor along with everything else
+    restore_character()
+
+    screen.set_clip(pygame.Rect(x * W, y * H, width * W, height * H))
+    screen.scroll(dx * W, dy * H)
+    screen.set_clip(None)
+    cell_data.scroll(x, y, width, height, dx, dy)
+    for row in range(y, y + height):
+        mark_damaged(row, x, x + width)
+    return True
+
+def draw_planes(source, planes, start_x, start_y):
+    """
+        render a planes-backed buffer to our backing.
+
+        The planes are copied into cell_data in one go (vectorized, if numpy is around),
+        which tells us exactly which cells changed and need new sprites.
+    """
+    changed = cell_data.blit(planes, start_x, start_y)
+    if not changed:
+        return
+
+    local_pages, local_areas, local_dests = pages, glyph_areas, cell_dests
+    local_fg, local_bg, local_ch = cell_data.fg, cell_data.bg, cell_data.ch
+
+    #make sure every page we need exists, then build the blits in one sweep
+    keys = [local_fg[i] | (local_bg[i] << 4) for i in changed]
+    for key in set(keys):
+        if local_pages[key] is None:
+            bake_page(key & 0xF, key >> 4)
+
+    flush_blits([
+        (local_pages[key], local_dests[i], local_areas[local_ch[i]])
+        for key, i in zip(keys, changed)
+    ])
+
+    #note which row spans changed, unless there's enough that we'll flip everything anyway
+    global damage
+    if damage is None:
+        return
+    if len(changed) > full_flip_fraction * max_x * max_y:
+        damage = None
+        return
+    screen_width = max_x
+    for i in changed:
+        y, x = divmod(i, screen_width)
+        mark_damaged(y, x, x + 1)
+
 def get_at(x, y):
     if x < 0 or x >= max_x or y < 0 or y >= max_y:
         raise ValueError("get_at: Invalid coordinate (%r, %r)" % (x,y))
-    global cell_data
-    return cell_data[y][x]
+    return cell_data.get(x, y)
 
 
 def prepare_raw_getkey():
@@ -7,9 +7,12 @@ import setup_logging
 import term
 colors = term.colors
 
-import buffer, boxtypes
+import buffer, boxtypes, compositor, ansi, snapshot, lru
 
 import pprint
+import StringIO
+import tempfile
+import os
 import random
 import time
 import logging
@@ -60,6 +63,17 @@ class PytalityCase(unittest.TestCase):
         if bg is not None:
             self.assertEqual(bg, tbg)
 
+    def count_draws(self):
+        #wrap the backend so we can see how often it gets called
+        calls = []
+        draw_buffer = term.impl.draw_buffer
+        def counting_draw_buffer(source, x, y):
+            calls.append((x, y, source.width, source.height))
+            return draw_buffer(source, x, y)
+        term.impl.draw_buffer = counting_draw_buffer
+        self.addCleanup(setattr, term.impl, 'draw_buffer', draw_buffer)
+        return calls
+
     def draw_box(self, box):
         """
         Draw a box, and check that it has drawn correctly
@@ -101,6 +115,111 @@ class Term(PytalityCase):
         self.check(0, 0, SPACE, colors.BLACK, colors.BLACK)
         self.check(self.width-1, self.height-1, SPACE, colors.BLACK, colors.BLACK)
 
+    def test_flip_damage(self):
+        if not hasattr(term.impl, 'damage_rects'):
+            self.skipTest("backend does not track display damage")
+        term.flip()
+
+        #a small change should only update the rows it touched
+        b = buffer.Buffer(width=5, height=2, x=3, y=4, data=[[[colors.RED, colors.BLUE, 'X']]*5]*2)
+        b.draw()
+        self.assertEqual(term.impl.damage, {4: [3, 8], 5: [3, 8]})
+        self.assertEqual(term.impl.damage_rects(), [term.impl.pygame.Rect(3*8, 4*12, 5*8, 2*12)])
+        term.flip()
+        self.assertEqual(term.impl.damage, {})
+        self.check(7, 5, 'X', colors.RED, colors.BLUE)
+
+        #and a big change just gives up and flips everything
+        b = buffer.Buffer(width=self.width, height=self.height, data=[[[colors.RED, colors.BLUE, 'Y']]*self.width]*self.height, storage='array')
+        b.draw()
+        self.assertEqual(term.impl.damage, None)
+        term.flip()
+        self.assertEqual(term.impl.damage, {})
+
+    def test_ansi_render(self):
+        if not hasattr(term.impl, 'render'):
+            self.skipTest("backend does not render ANSI output")
+        term.flip()
+        self.assertEqual(term.impl.render(), '')
+
+        #runs of changed cells need one cursor move, and colors are only set when they change
+        buffer.Buffer(width=3, height=1, x=2, y=1, data=[[[colors.RED, colors.BLUE, c] for c in 'ABC']]).draw()
+        buffer.Buffer(width=1, height=1, x=10, y=1, data=[[[colors.RED, colors.BLUE, 'D']]]).draw()
+        buffer.Buffer(width=1, height=1, x=11, y=1, data=[[[colors.WHITE, colors.BLACK, '\x01']]]).draw()
+        self.assertEqual(term.impl.render(), '\x1b[2;3H\x1b[31;44mABC\x1b[2;11HD\x1b[97;40m\xe2\x98\xba')
+        self.assertEqual(term.impl.render(), '')
+        self.check(11, 1, '\x01', colors.WHITE, colors.BLACK)
+
+    def test_color_pairs(self):
+        if not hasattr(term.impl, 'lru_color'):
+            self.skipTest("backend does not allocate color pairs")
+        #pretend the terminal only has a few color pairs to go around
+        curses = term.impl.curses
+        color_pairs = curses.COLOR_PAIRS
+        try:
+            curses.COLOR_PAIRS = 4
+            term.impl.init_colors()
+            for bg in range(8):
+                for fg in range(16):
+                    buffer.Buffer(width=1, height=1, x=fg, y=bg, data=[[[fg, bg, 'Q']]]).draw()
+            term.flip()
+            self.assertEqual(len(term.impl.pair_lru), 3)
+            self.check(15, 7, 'Q')
+        finally:
+            curses.COLOR_PAIRS = color_pairs
+            term.impl.init_colors()
+
+    def test_glyph_cells(self):
+        if not hasattr(term.impl, 'glyph_indexes'):
+            self.skipTest("backend does not draw Glyphs")
+        #a cell's character can be a cp437 character, a glyph index, or an already-converted Glyph
+        glyphs = term.impl.glyphs
+        data = [[[colors.WHITE, colors.BLACK, ch] for ch in ('A', 1, glyphs[2], glyphs[ord('B')], 0xdb)]]
+        buffer.Buffer(width=5, height=1, x=3, y=2, data=data).draw()
+        term.flip()
+        for x, ch in enumerate(('A', '\x01', '\x02', 'B', '\xdb')):
+            self.check(3 + x, 2, ch)
+        self.assertEqual(list(term.impl.shadow.ch[term.impl.shadow.index(3, 2):][:5]), [65, 1, 2, 66, 0xdb])
+
+    def test_unknown_glyph_cells(self):
+        if not hasattr(term.impl, 'glyph_indexes'):
+            self.skipTest("backend does not draw Glyphs")
+        data = [[[colors.WHITE, colors.BLACK, ch] for ch in ('A', '\x00', 'D')]]
+        buf = buffer.Buffer(width=3, height=1, x=3, y=2, data=data)
+        buf.draw()
+        term.flip()
+        #a cell holding several characters is drawn as they are, and a full redraw draws the next cell over the overflow
+        buf.set_at(1, 0, 'bc')
+        buf.dirty = True
+        buf.draw()
+        term.flip()
+        for x, ch in enumerate('AbD'):
+            self.check(3 + x, 2, ch)
+        #...and putting the old character back isn't mistaken for what the shadow still holds
+        buf.set_at(1, 0, '\x00')
+        buf.draw()
+        term.flip()
+        self.check(4, 2, SPACE)
+
+    def test_color_attr_cache(self):
+        if not hasattr(term.impl, 'lru_color'):
+            self.skipTest("backend does not allocate color pairs")
+        if term.impl.pair_lru is not None:
+            self.skipTest("terminal is sharing out color pairs")
+        #white on black is pair 0, an attribute of 0 - it still shouldn't need looking up
+        self.assertEqual(term.impl.color_attrs[colors.LIGHTGREY], 0)
+        calls = []
+        def counting(original):
+            return lambda *args: calls.append(args) or original(*args)
+        for name in ('get_color', 'lru_color'):
+            original = getattr(term.impl, name)
+            setattr(term.impl, name, counting(original))
+            self.addCleanup(setattr, term.impl, name, original)
+        buffer.Buffer(width=4, height=2, x=1, y=1, data=[[[colors.LIGHTGREY, colors.BLACK, 'W']] * 4] * 2).draw()
+        term.flip()
+        self.check(4, 2, 'W')
+        self.assertEqual(calls, [])
+
     def test_repeat_setup(self):
         self.setUp()
         self.tearDown()
@@ -295,6 +414,114 @@ class Buffer(PytalityCase):
             r.choice(boxes).draw()
             term.flip()
 
+    def test_array_storage(self):
+        box = buffer.Box(x=10, y=10, width=6, height=6, storage='array')
+        self.assertTrue(box._planes is not None)
+        self.draw_box(box)
+
+        #the row/cell protocol still works through the view
+        self.assertEqual(box._data[0][0], [box.border_fg, box.border_bg, boxtypes.BoxDouble.tl])
+        self.assertEqual(box._data[1][1:3], [[box.interior_fg, box.interior_bg, ' ']] * 2)
+
+        box.set_at(2, 2, '0', colors.LIGHTGREY)
+        self.assertEqual(box._data[2][2], [colors.LIGHTGREY, box.interior_bg, '0'])
+        box.draw()
+        term.flip()
+        self.check(12, 12, '0')
+        self.check(13, 13, ' ')
+
+        #blits of planes into the backend should match what was drawn
+        big = buffer.Box(x=0, y=0, width=self.width, height=self.height, storage='numpy',
+                        interior_bg=colors.BLUE)
+        big.set_at(5, 6, 'Z', colors.YELLOW)
+        big.draw()
+        term.flip()
+        self.check(5, 6, 'Z', colors.YELLOW, colors.BLUE)
+        self.check(0, 0, boxtypes.BoxDouble.tl)
+        self.check(self.width-2, self.height-2, SPACE, bg=colors.BLUE)
+
+        blank = buffer.Buffer(width=3, height=2, storage='array')
+        self.assertEqual(blank._data[1][2], [colors.BLACK, colors.BLACK, ' '])
+        self.assertRaises(ValueError, buffer.Buffer, width=4, height=4, data=blank._planes)
+
+    def test_buffer_view(self):
+        data = [[[x % 16, y % 8, chr(ord('A') + (x + y) % 26)] for x in range(30)] for y in range(20)]
+        for storage in ('list', 'array'):
+            parent = buffer.Buffer(width=30, height=20, data=data, storage=storage)
+            view = buffer.BufferView(width=10, height=5, x=2, y=3, parent=parent)
+            for scroll_x, scroll_y in [(0, 0), (4, 2), (15, 12), (10, 0), (-40, -40)]:
+                term.clear()
+                view.scroll(x=scroll_x, y=scroll_y)
+                view.draw()
+                term.flip()
+                for y in range(5):
+                    for x in range(10):
+                        px, py = view.view_x + x, view.view_y + y
+                        if px < 30 and py < 20:
+                            fg, bg, ch = data[py][px]
+                            self.check(2 + x, 3 + y, ch, fg, bg)
+                        else:
+                            #past the edge of the parent, nothing is drawn
+                            self.check(2 + x, 3 + y, SPACE, bg=colors.BLACK)
+
+            #writing to the parent shows through
+            view.view_x, view.view_y = 5, 5
+            parent.set_at(6, 7, '!')
+            view.draw()
+            term.flip()
+            self.check(3, 5, '!')
+
+    def test_buffer_view_scroll(self):
+        data = [[[x % 16, y % 8, chr(ord('A') + (x * 3 + y) % 26)] for x in range(30)] for y in range(20)]
+        fast = hasattr(term.impl, 'scroll_rect')
+        for storage in ('list', 'array'):
+            term.clear()
+            parent = buffer.Buffer(width=30, height=20, data=data, storage=storage)
+            view = buffer.BufferView(width=12, height=6, x=2, y=3, parent=parent, view_x=5, view_y=5)
+            view.draw()
+            term.flip()
+            calls = self.count_draws()
+            for scroll_x, scroll_y in [(0, 1), (1, 0), (0, -2), (-3, 0), (2, 2), (0, 0), (20, 0), (-20, -20), (1, 1)]:
+                del calls[:]
+                view.scroll(x=scroll_x, y=scroll_y)
+                view.draw()
+                term.flip()
+                if fast and (scroll_x, scroll_y) in [(0, 1), (1, 0), (0, -2), (-3, 0)]:
+                    #only the uncovered edge was drawn
+                    self.assertEqual(sum([w * h for x, y, w, h in calls]), abs(scroll_x) * 6 + abs(scroll_y) * 12)
+                for y in range(6):
+                    for x in range(12):
+                        px, py = view.view_x + x, view.view_y + y
+                        if px < 30 and py < 20:
+                            fg, bg, ch = data[py][px]
+                            self.check(2 + x, 3 + y, ch, fg, bg)
+
+                if hasattr(term.impl, 'screen'):
+                    #the moved pixels should be just what drawing it all again gives
+                    pygame = term.impl.pygame
+                    area = pygame.Rect(2 * term.impl.W, 3 * term.impl.H, 12 * term.impl.W, 6 * term.impl.H)
+                    pixels = pygame.image.tostring(term.impl.screen.subsurface(area), 'RGB')
+                    term.impl.cell_data = term.impl.cells.DefaultPlanes(self.width, self.height)
+                    view.dirty = True
+                    view.draw()
+                    self.assertEqual(pixels, pygame.image.tostring(term.impl.screen.subsurface(area), 'RGB'))
+
+        if hasattr(term.impl, 'pending_scrolls'):
+            #wide enough views have the terminal scroll the lines itself
+            term.flip()
+            wide = [[[colors.WHITE, colors.BLUE, chr(ord('a') + y % 26)] for x in range(self.width)] for y in range(40)]
+            parent = buffer.Buffer(width=self.width, height=40, data=wide)
+            view = buffer.BufferView(width=self.width, height=10, y=3, parent=parent)
+            view.draw()
+            term.flip()
+            view.scroll(y=1)
+            view.draw()
+            out = term.impl.render()
+            self.assertTrue(out.startswith('\x1b[4;13r\x1b[1S\x1b[r'))
+            #just the new line is written
+            self.assertEqual(out.count('k'), self.width)
+            self.assertEqual(out.count('b'), 0)
+
 class PlainText(PytalityCase):
     def test_make_text(self):
         msg = "abcdef"
@@ -326,6 +553,116 @@ class PlainText(PytalityCase):
         self.check(1, 0, 'b')
         self.check(4, 2, 'c')
 
+    def test_update_in_place(self):
+        for storage in ('list', 'array', 'numpy'):
+            txt = buffer.PlainText("Score: %5d", x=2, y=3, storage=storage)
+            txt.format(100)
+            txt.draw()
+            calls = self.count_draws()
+
+            #only the digit that changed is redrawn
+            txt.format(101)
+            self.assertEqual(txt.damage, {0: [11, 12]})
+            txt.draw()
+            self.assertEqual(calls, [(13, 3, 1, 1)])
+            term.flip()
+            self.check(13, 3, '1')
+
+            #nothing changed, so nothing is drawn
+            del calls[:]
+            txt.format(101)
+            txt.draw()
+            self.assertEqual(calls, [])
+
+            #a different width needs a whole new row
+            txt.set("Game over")
+            self.assertEqual((txt.dirty, txt.damage), (True, None))
+            txt.draw()
+            self.assertEqual(calls, [(2, 3, 9, 1)])
+            #and keeps the storage it was made with
+            self.assertEqual(txt._planes is None, storage == 'list')
+            term.flip()
+            self.check(10, 3, 'r')
+
+        #rich text too, including colors
+        txt = buffer.RichText("<RED>%s</>\n<GREEN>%s</>")
+        txt.format(("ab", "cd"))
+        txt.draw()
+        txt.format(("ab", "ce"))
+        self.assertEqual(txt.damage, {1: [1, 2]})
+        txt.set("<RED>ab</>\n<BLUE>ce</>")
+        self.assertEqual(txt.damage, {1: [0, 2]})
+        txt.draw()
+        term.flip()
+        self.check(0, 1, 'c', fg=colors.BLUE)
+
+class RichText(PytalityCase):
+    def test_compiled_format(self):
+        templates = [
+            "HP: <RED>%d</>/<GREEN>%d</>", "<YELLOW>%d<BLUE>\n%d</> x\n\n", "%d <> %d",
+            "%d < %d", "<BOGUS>%d<RED>%d</>", "%d<RED>%d</></>", "<RED>%%%d%%</> %d", "<RED>%s</>!%s",
+        ]
+        values = [(1, 2), (30, 400), ("<WHITE>", "</>"), ("<RED>\n\n", "x\0y"), ("a\0b", "c")]
+        for template in templates:
+            txt = buffer.RichText(template, wrap_to=7)
+            for fmt in values:
+                try:
+                    expected = buffer.RichText(template % fmt, wrap_to=7)
+                except (TypeError, IndexError):
+                    self.assertRaises((TypeError, IndexError), txt.format, fmt)
+                    continue
+                txt.format(fmt)
+                self.assertEqual(txt.message, template % fmt)
+                self.assertEqual((txt.width, txt.height, txt._data), (expected.width, expected.height, expected._data))
+
+    def test_row_cache(self):
+        buffer.RichText.row_cache.max_size = 2
+        try:
+            txt = buffer.RichText("<RED>a</>%s")
+            for i in range(3):
+                for fmt in ("b", "c", "d\ne"):
+                    txt.format(fmt)
+                    self.assertEqual(txt._data, buffer.RichText(txt.message)._data)
+            self.assertEqual(len(buffer.RichText.row_cache), 2)
+
+            #changing the text must not change what's cached
+            txt.format("b")
+            txt.set_at(0, 0, 'z')
+            txt.format("c")
+            txt.format("b")
+            self.assertEqual([cell[2] for cell in txt._data[0]], ['a', 'b'])
+        finally:
+            buffer.RichText.row_cache.max_size = 0
+            buffer.RichText.row_cache.clear()
+
+    def test_word_wrap(self):
+        def rows(txt):
+            return [''.join([cell[2] for cell in row]) for row in txt._data]
+
+        txt = buffer.RichText("The <RED>quick brown</> fox-like dog\njumped   over", wrap_to=10, word_wrap=True)
+        self.assertEqual(rows(txt), ["The quick ", "brown fox-", "like dog  ", "jumped    ", "over      "])
+        #colors carry on across the break
+        self.assertEqual([cell[0] for cell in txt._data[1][:6]], [colors.RED] * 5 + [colors.LIGHTGREY])
+
+        txt = buffer.RichText("a <GREEN>supercalifragilistic</> word", wrap_to=8, word_wrap=True, hyphenate=True)
+        self.assertEqual(rows(txt), ["a       ", "superca-", "lifragi-", "listic  ", "word    "])
+        self.assertEqual(txt._data[1][7], [colors.GREEN, colors.BLACK, '-'])
+
+        for msg in ["", "\n", "a\nb\n", "<RED>red</> " * 5, "x" * 18, "x" * 19, "word " * 10, "a " + "-" * 30, " " * 40]:
+            for hyphenate in (False, True):
+                txt = buffer.RichText(msg, wrap_to=9, word_wrap=True, hyphenate=hyphenate)
+                self.assertEqual(buffer.RichText.measure(msg, wrap_to=9, word_wrap=True, hyphenate=hyphenate), txt.height)
+                self.assertEqual(txt.width, 9)
+
+        #message boxes wrap the same way
+        box = buffer.MessageBox(width=12, height=10, word_wrap=True)
+        box.add("The <RED>quick brown</> fox-like dog\njumped   over")
+        box.draw()
+        term.flip()
+        self.assertEqual(box.total_lines, 5)
+        self.check(1, 2, 'b', fg=colors.RED)
+        self.check(10, 2, '-')
+
 class Box(PytalityCase):
     def test_make_box(self):
         box = buffer.Box(x=10, y=10, width=4, height=4)
@@ -414,6 +751,76 @@ class Box(PytalityCase):
         self.check(12, 13, ' ')
         self.check(13, 12, ' ')
 
+    def test_damage(self):
+        box = buffer.Box(x=0, y=0, width=20, height=10)
+        child = buffer.Box(x=8, y=3, width=4, height=4, interior_bg=colors.RED)
+        box.children.append(child)
+        box.draw()
+        term.flip()
+        self.assertFalse(box.dirty)
+
+        #paint something on top of the box, which a full redraw would erase
+        cover = buffer.Buffer(x=2, y=2, width=2, height=2, data=[[[colors.WHITE, colors.BLUE, '#']]*2]*2)
+        cover.draw()
+
+        box.set_at(5, 6, 'x')
+        box.set_at(7, 6, 'y')
+        box.set_at(0, 1, 'z')
+        self.assertEqual(box.damage, {6: [5, 8], 1: [0, 1]})
+        box.draw()
+        term.flip()
+        self.assertFalse(box.dirty)
+        self.check(5, 6, 'x')
+        self.check(7, 6, 'y')
+        self.check(0, 1, 'z')
+        self.check(2, 2, '#', colors.WHITE, colors.BLUE)
+
+        #damage under a child redraws the child on top
+        box.set_at(10, 5, 'q')
+        box.draw()
+        term.flip()
+        self.check(10, 5, SPACE, bg=colors.RED)
+
+        #moving, or dirtying directly, still redraws everything
+        box.set_at(1, 1, 'w')
+        box.dirty = True
+        self.assertEqual(box.damage, None)
+        box.draw()
+        term.flip()
+        self.check(2, 2, SPACE)
+
+    def test_culling(self):
+        calls = self.count_draws()
+
+        #entirely off-screen buffers never reach the backend
+        for x, y in [(-5, 0), (0, -5), (self.width, 0), (0, self.height)]:
+            buffer.Box(x=x, y=y, width=5, height=5).draw()
+        self.assertEqual(calls, [])
+
+        #partially visible ones do
+        buffer.Box(x=-4, y=-4, width=5, height=5).draw()
+        self.assertEqual(len(calls), 1)
+
+        #a child completely covered by a later sibling is skipped
+        del calls[:]
+        root = buffer.Buffer(width=0, height=0)
+        hidden = buffer.PlainText("hidden", x=3, y=3)
+        cover = buffer.Box(x=2, y=2, width=10, height=3, interior_bg=colors.RED)
+        beside = buffer.PlainText("beside", x=20, y=3)
+        root.children.extend([hidden, cover, beside])
+        root.draw()
+        term.flip()
+        self.assertEqual(calls, [(2, 2, 10, 3), (20, 3, 6, 1)])
+        self.assertFalse(hidden.dirty)
+        self.check(3, 3, SPACE, bg=colors.RED)
+        self.check(20, 3, 'b')
+
+        #but only when the cover is actually being redrawn
+        del calls[:]
+        hidden.set("HIDDEN")
+        root.draw()
+        self.assertEqual(calls, [(3, 3, 6, 1)])
+
 class MessageBox(PytalityCase):
     def add(self, msg, **kwargs):
         if isinstance(msg, list):
@@ -471,6 +878,89 @@ class MessageBox(PytalityCase):
         term.flip()
         self.check(6, 6, '9')
 
+    def test_line_index(self):
+        box = self.box = buffer.MessageBox(x=5, y=5, width=20, height=7)
+        self.add(["one", "two\ntwo", "three\nthree\nthree", "four"])
+        self.assertEqual(box.line_ends, [1, 3, 6, 7])
+        self.assertEqual(box.total_lines, 7)
+
+        #the view starts partway into the third message
+        self.scroll(home=True)
+        self.scroll(4)
+        self.assertEqual(box.offset, 2)
+        self.check(6, 6, 't')
+        self.check(7, 6, 'w')
+        self.check(6, 7, 't')
+        self.check(7, 7, 'h')
+        self.check(6, 10, 'f')
+
+    def test_history_cap(self):
+        box = self.box = buffer.MessageBox(x=5, y=5, width=20, height=12, max_messages=50)
+        self.add(["line %s" % i for i in range(200)])
+        self.assertEqual(len(box.messages), 50)
+        self.assertEqual(box.total_lines, 50)
+        self.check(13, 6, '0')
+        self.check(13, 15, '9')
+
+        box = self.box = buffer.MessageBox(x=5, y=5, width=20, height=12, max_lines=30)
+        self.add(["%s!\n%s?" % (i, i) for i in range(20)])
+        self.assertEqual(box.total_lines, 30)
+        self.check(6, 6, '1')
+        self.check(7, 6, '5')
+        self.check(8, 6, '!')
+
+        #dropping lines from the start shouldn't move what we're looking at
+        self.scroll(home=True)
+        self.scroll(3)
+        self.check(6, 6, '6')
+        self.check(7, 6, '?')
+        self.add("more\nmore", scroll=False)
+        self.assertEqual(box.total_lines, 30)
+        self.assertEqual(box.offset, 1)
+        self.check(6, 6, '6')
+        self.check(7, 6, '?')
+        self.check(box.x + box.width - 1, box.y + 1, box.boxtype.scrollbar_center)
+
+        #unless they were the lines on screen
+        self.add("more", scroll=False)
+        self.assertEqual(box.total_lines, 29)
+        self.assertEqual(box.offset, 0)
+        self.check(6, 6, '7')
+        self.check(7, 6, '!')
+        self.check(box.x + box.width - 1, box.y + 1, box.boxtype.scrollbar_top)
+
+    def test_lazy_render(self):
+        box = self.box = buffer.MessageBox(x=5, y=5, width=20, height=12)
+        self.add(["thousand %s" % i for i in range(1000)])
+        #only the last screenful should have been rendered
+        self.assertEqual(len(box.rendered), box.inner_height)
+        self.check(15, 15, '9')
+
+        self.scroll(home=True)
+        self.assertEqual(len(box.rendered), box.inner_height * 2)
+        self.check(15, 6, '0')
+
+        for msg in ["", "\n", "a\nb\n", "<RED>red</> " * 5, "x" * 18, "x" * 19, "<GREEN>" + "y" * 40]:
+            self.assertEqual(buffer.RichText.measure(msg, wrap_to=18), buffer.RichText(msg, wrap_to=18).height)
+
+    def test_scroll_redraw(self):
+        for scrollbar_type in ("edge", "block"):
+            box = self.box = buffer.MessageBox(x=5, y=5, width=20, height=8, scrollbar_type=scrollbar_type)
+            self.add(["message %s" % i for i in range(3)] + ["two\nlines %s" % i for i in range(10)])
+            calls = self.count_draws()
+            for delta in [-1, -1, -3, 2, -20, 5]:
+                del calls[:]
+                self.scroll(delta)
+                #scrolling moves the messages around, but the box itself doesn't need redrawing
+                self.assertNotIn((box.x, box.y, box.width, box.height), calls)
+
+                #and the result should be just the same as drawing everything
+                screen = [term.get_at(x, y) for y in range(box.y, box.y + box.height) for x in range(box.x, box.x + box.width)]
+                box.dirty = True
+                box.draw()
+                term.flip()
+                self.assertEqual(screen, [term.get_at(x, y) for y in range(box.y, box.y + box.height) for x in range(box.x, box.x + box.width)])
+
     def test_edge_scrollbar(self):
         bt = boxtypes.BoxDouble
         box = self.box = buffer.MessageBox(x=1, y=20, width=20, height=20,
@@ -524,7 +1014,222 @@ class MessageBox(PytalityCase):
         self.check(r, b, bt.scrollbar_bottom)
 
 
+class Compositor(PytalityCase):
+    def test_composite(self):
+        root = buffer.Buffer(width=0, height=0)
+        outer = buffer.Box(x=2, y=2, width=30, height=20, interior_bg=colors.BLUE)
+        inner = buffer.Box(x=3, y=3, width=10, height=5, interior_bg=colors.RED)
+        outer.children.append(inner)
+        text = buffer.PlainText("hello", x=1, y=1)
+        inner.children.append(text)
+        root.children.append(outer)
+        comp = compositor.Compositor(root, width=self.width, height=self.height)
+
+        calls = self.count_draws()
+        comp.draw()
+        term.flip()
+        self.assertEqual(len(calls), 1)
+        self.check(2, 2, boxtypes.BoxDouble.tl)
+        self.check(3, 3, SPACE, bg=colors.BLUE)
+        self.check(6, 6, boxtypes.BoxDouble.tl)
+        self.check(7, 7, SPACE, bg=colors.RED)
+        self.check(8, 8, 'h')
+        self.check(12, 8, 'o')
+        self.check(0, 0, SPACE, colors.BLACK, colors.BLACK)
+
+        #nothing changed, nothing sent
+        del calls[:]
+        comp.draw()
+        self.assertEqual(calls, [])
+
+        #dirtying the whole outer box only sends the cells that actually changed
+        outer.set_at(1, 1, 'x')
+        text.set("HELLO")
+        outer.dirty = True
+        comp.draw()
+        term.flip()
+        self.assertEqual(calls, [(3, 3, 1, 1), (8, 8, 5, 1)])
+        self.check(3, 3, 'x', bg=colors.BLUE)
+        self.check(8, 8, 'H')
+        self.check(7, 7, SPACE, bg=colors.RED)
+
+        #after invalidating, everything goes out again
+        del calls[:]
+        term.clear()
+        comp.invalidate()
+        comp.draw()
+        term.flip()
+        self.assertEqual(len(calls), 1)
+        self.check(2, 2, boxtypes.BoxDouble.tl)
+
+class Ansi(PytalityCase):
+    art = ('\x1b[0;31mred\x1b[1;44m bold\r\n'
+           '\x1b[3C' + 'x' * 12 + '\r\n'
+           '\x1b[0;32m' + '\xdb' * 25 + '\x1b[0m')
+
+    def read(self, art=None, **kwargs):
+        #bold and the last color carry over between escapes, so start from scratch
+        ansi.bold, ansi.last_color = 0, 37
+        return list(ansi.read_rows(StringIO.StringIO(art or self.art), **kwargs))
+
+    def test_read_rows(self):
+        rows = self.read(width=10)
+        self.assertEqual(rows[0][0], [colors.RED, colors.BLACK, 'r'])
+        self.assertEqual(rows[0][4], [colors.LIGHTRED, colors.BLUE, 'b'])
+        #short rows are padded out with the current colors
+        self.assertEqual(rows[0][9], [colors.LIGHTRED, colors.BLUE, ' '])
+        #a cursor-right is black space, and long rows wrap
+        self.assertEqual(rows[2][:4], [[colors.BLACK, colors.BLACK, ' ']] * 3 + [[colors.LIGHTRED, colors.BLUE, 'x']])
+        self.assertEqual(''.join(c[2] for c in rows[3]), 'xxxxx     ')
+        self.assertEqual(len(rows), 8)
+        self.assertTrue(all(len(row) == 10 for row in rows))
+
+        #escapes split across chunks come out the same
+        for chunk_size in (1, 2, 5):
+            self.assertEqual(self.read(width=10, chunk_size=chunk_size), rows)
+
+        cropped = self.read(width=10, crop=True)
+        self.assertEqual(len(cropped), 5)
+        self.assertEqual(cropped[:3], rows[:3])
+        self.assertEqual(cropped[4], rows[5])
+
+    def test_read_to_buffer(self):
+        rows = self.read(width=10)
+        for storage in ('list', 'array', 'numpy'):
+            ansi.bold, ansi.last_color = 0, 37
+            buf = ansi.read_to_buffer(StringIO.StringIO(self.art), width=10, max_height=4, storage=storage)
+            self.assertEqual(buf.height, 4)
+            self.assertEqual([[list(buf._data[y][x]) for x in range(10)] for y in range(4)], rows[:4])
+
+    def test_mapped_rows(self):
+        #mapped files get one row per CRLF line, like the LF version through read_rows
+        rows = self.read(self.art.replace('\r\n', '\n'), width=10)
+        fd, path = tempfile.mkstemp(suffix='.ans')
+        os.close(fd)
+        try:
+            with open(path, 'wb') as f:
+                f.write('width: 10\r\n' + self.art)
+            ansi.bold, ansi.last_color = 0, 37
+            buf = ansi.map_to_buffer(path, width=10, offset=len('width: 10\r\n'), max_rows=4)
+        finally:
+            os.remove(path)
+        self.assertEqual(buf.height, len(rows))
+        self.assertEqual(len(buf._data.rows), 0)
+
+        #rows come out the same whatever order they're decoded in
+        for y in (4, 0, 5, 1):
+            self.assertEqual(buf._data[y], rows[y])
+        self.assertEqual(buf._data[-1], rows[-1])
+        self.assertEqual(buf._data[2:4], rows[2:4])
+        #...and only the last few are kept
+        self.assertEqual(sorted(buf._data.rows), [1, 2, 3, 5])
+
+        view = buffer.BufferView(width=10, height=2, parent=buf, view_y=3, x=2, y=3)
+        view.draw()
+        term.flip()
+        self.check(2, 3, '\xdb', colors.GREEN)
+        self.check(2, 4, '\xdb', colors.GREEN)
+        self.assertEqual(sorted(buf._data.rows), [2, 3, 4, 5])
+
+        #changed rows are kept, however many others are looked at
+        buf.set_at(1, 0, 'Z')
+        buf._data[1] = [[colors.RED, colors.BLACK, 'Y']] * 10
+        for y in range(buf.height):
+            buf._data[y]
+        self.assertEqual(buf._data[0][1], [colors.RED, colors.BLACK, 'Z'])
+        self.assertEqual(buf._data[1][0], [colors.RED, colors.BLACK, 'Y'])
+        self.assertEqual(sorted(buf._data.pinned), [0, 1])
+
+class Snapshot(PytalityCase):
+    def make_tree(self):
+        text = buffer.PlainText("Hello", x=2, y=1, fg=colors.YELLOW, bg=colors.BLUE)
+        inner = buffer.Box(x=3, y=4, width=10, height=5, children=[text], storage='array')
+        return buffer.Box(x=1, y=2, width=20, height=12, padding_x=2, padding_y=1,
+                          children=[inner, buffer.PlainText("\xdb", x=-1, y=0)])
+
+    def assertSameTree(self, a, b):
+        self.assertEqual((a.width, a.height, a.x, a.y, a.padding_x, a.padding_y),
+                         (b.width, b.height, b.x, b.y, b.padding_x, b.padding_y))
+        self.assertEqual([[list(cell) for cell in row] for row in a._data],
+                         [[list(cell) for cell in row] for row in b._data])
+        self.assertEqual(len(a.children), len(b.children))
+        for child_a, child_b in zip(a.children, b.children):
+            self.assertSameTree(child_a, child_b)
+
+    def test_round_trip(self):
+        root = self.make_tree()
+        data = snapshot.dumps(root)
+        self.assertEqual(data[:4], 'PYTB')
+        loaded = snapshot.loads(data)
+        self.assertTrue(loaded._planes is not None)
+        self.assertSameTree(root, loaded)
+
+        #compressed trees come back the same too
+        packed = snapshot.dumps(root, compress=True)
+        self.assertTrue(len(packed) < len(data))
+        self.assertSameTree(root, snapshot.loads(packed, storage='numpy'))
+
+        self.assertRaises(snapshot.SnapshotError, snapshot.loads, 'JUNK' + data[4:])
+        self.assertRaises(snapshot.SnapshotError, snapshot.loads, data[:40])
+
+    def test_save_load(self):
+        root = self.make_tree()
+        fd, path = tempfile.mkstemp(suffix='.snap')
+        os.close(fd)
+        try:
+            snapshot.save(root, path)
+            loaded = snapshot.load(path)
+        finally:
+            os.remove(path)
+        self.assertSameTree(root, loaded)
+
+        #the loaded cells don't depend on the file
+        loaded.set_at(0, 0, 'Q')
+        loaded.draw()
+        term.flip()
+        self.check(1, 2, 'Q')
+        #root (1, 2) + padding (2, 1) + inner (3, 4) + its padding (1, 1) + text (2, 1)
+        self.check(9, 9, 'H', colors.YELLOW, colors.BLUE)
+
+class LRUCache(unittest.TestCase):
+    def test_lru(self):
+        cache = lru.LRUCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        #b is now the least recently used, so it goes
+        cache.put('c', 3)
+        self.assertEqual(list(cache), ['a', 'c'])
+        self.assertEqual(cache.get('b', 'gone'), 'gone')
+        self.assertEqual(cache.pop_oldest(), ('a', 1))
+
+        #0 keeps nothing, None keeps everything
+        off, unlimited = lru.LRUCache(0), lru.LRUCache()
+        for i in range(100):
+            off.put(i, i)
+            unlimited.put(i, i)
+        self.assertEqual((len(off), len(unlimited)), (0, 100))
+
+class Memory(PytalityCase):
+    force_backend = 'memory'
+
+    def test_scripted_keys(self):
+        term.impl.push_keys('a', '\x01', 'up')
+        self.assertEqual(term.getkey(), 'a')
+        self.assertEqual(term.getkey(), 'ctrl-a')
+        self.assertEqual(term.getkey(), 'up')
+        self.assertRaises(term.impl.NoMoreInputError, term.getkey)
+
+    def test_frames(self):
+        b = buffer.Box(width=10, height=5, x=2, y=3)
+        b.draw()
+        term.flip()
+        term.flip()
+        self.assertEqual(term.impl.frames, 2)
+        self.check(2, 3, boxtypes.BoxDouble.tl)
+
 class Microgames(PytalityCase):
+    storage = 'list'
 
     def test_waterfall(self):
         #make a silly little waterfall
@@ -535,7 +1240,7 @@ class Microgames(PytalityCase):
         def make_fall():
             color = random.choice([colors.WHITE, colors.LIGHTGREY, colors.LIGHTBLUE, colors.BLUE])
             x = int(random.triangular(0, self.width, mode=center))
-            return buffer.Buffer(width=1, height=5, x=x, y=-4, data=[
+            return buffer.Buffer(width=1, height=5, x=x, y=-4, storage=self.storage, data=[
                 [[color, colors.BLACK, ' ']],
                 [[color, colors.BLACK, '\xb0']],
                 [[color, colors.BLACK, '\xb1']],
@@ -562,7 +1267,7 @@ class Microgames(PytalityCase):
             term.flip()
         end = time.time()
         fps = frames / (end - start)
-        log.debug("waterfall FPS: %.2f over %r frames", fps, frames)
+        log.debug("waterfall FPS (%s): %.2f over %r frames", self.storage, fps, frames)
         self.assertGreater(fps, 40)
 
     def test_pattern(self):
@@ -592,7 +1297,7 @@ class Microgames(PytalityCase):
                 seen.add((nx, ny))
                 candidates.append((nx, ny, depth+1))
 
-            b = buffer.Buffer(x=x, y=y, width=1, height=1, data=[
+            b = buffer.Buffer(x=x, y=y, width=1, height=1, storage=self.storage, data=[
                 [
                     [step % 15 + 1, colors.BLACK, '\xb0']
                 ]
@@ -606,12 +1311,49 @@ class Microgames(PytalityCase):
         term.flip()
         end = time.time()
         fps = draws / (end - start)
-        log.debug("pattern FPS: %.2f over %r frames", fps, draws)
+        log.debug("pattern FPS (%s): %.2f over %r frames", self.storage, fps, draws)
+
+    def test_fullscreen(self):
+        #redraw a screen-sized buffer that changes a little every frame
+        r = random.Random()
+        r.seed(1356317227)
+        box = buffer.Box(width=self.width, height=self.height, storage=self.storage)
+        box.draw()
+        calls = self.count_draws()
+
+        frames = 100
+        written = {}
+        start = time.time()
+        for i in range(frames):
+            x = r.randint(1, self.width-2)
+            y = r.randint(1, self.height-2)
+            written[x, y] = (chr(r.randint(33, 126)), r.randint(1, 15))
+            box.set_at(x=x, y=y, char=written[x, y][0], fg=written[x, y][1])
+            box.draw()
+            term.flip()
+
+            #only the damaged cell is redrawn
+            self.assertEqual(calls, [(x, y, 1, 1)])
+            del calls[:]
+        end = time.time()
+        fps = frames / (end - start)
+        log.debug("fullscreen FPS (%s): %.2f over %r frames", self.storage, fps, frames)
+
+        for (x, y), (char, fg) in written.items():
+            self.check(x, y, char, fg, box.interior_bg)
+        self.check(0, 0, boxtypes.BoxDouble.tl)
+
+class ArrayMicrogames(Microgames):
+    storage = 'array'
+
+@unittest.skipUnless(buffer.cells.numpy, "numpy is not installed")
+class NumpyMicrogames(Microgames):
+    storage = 'numpy'
 
 
 if __name__ == "__main__":
     import sys
-    if len(sys.argv) > 1 and sys.argv[1] in ['silverlight', 'pygame', 'winconsole', 'curses']:
+    if len(sys.argv) > 1 and sys.argv[1] in ['silverlight', 'pygame', 'winconsole', 'curses', 'ansi', 'memory']:
         PytalityCase.force_backend = sys.argv.pop(1)
 
     if 'profile' in sys.argv: